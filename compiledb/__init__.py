@@ -21,14 +21,59 @@
 
 import json
 import os
+import shutil
 import sys
 import logging
+import tempfile
+import time
+from contextlib import contextmanager
+from itertools import islice
 
-from compiledb.parser import parse_build_log, Error
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from compiledb import cache
+from compiledb.client import send_entries
+from compiledb.entry import to_dict
+from compiledb.parser import parse_build_log, resolve_predefined_macros, Error, ParsingResult
+from compiledb.utils import FileExistenceCache, FollowedStream
 
 
 logger = logging.getLogger(__name__)
 
+# Number of entries whose directories are listed at once when merging
+MERGE_CHUNK_SIZE = 4096
+
+# Use a faster JSON encoder for compact output, if available
+try:
+    import orjson
+
+    def _dumps_compact(obj):
+        return orjson.dumps(obj).decode('utf-8')
+except ImportError:
+    _dumps_compact = json.JSONEncoder(separators=(',', ':')).encode
+
+
+_encode_string = json.encoder.encode_basestring_ascii
+
+
+def _dumps_pretty(obj):
+    """Same as json.dumps(obj, indent=1), for an entry nested in the top level list.
+       Entries holding only strings and lists of strings are formatted directly."""
+    try:
+        items = []
+        for key, value in obj.items():
+            if isinstance(value, list):
+                value = '[\n   ' + ',\n   '.join(map(_encode_string, value)) + '\n  ]' if value else '[]'
+            else:
+                value = _encode_string(value)
+            items.append('  ' + _encode_string(key) + ': ' + value)
+        return '{\n' + ',\n'.join(items) + '\n }' if items else '{}'
+    except TypeError:
+        return json.dumps(obj, indent=1).replace('\n', '\n ')
+
 
 def __is_stdout(pfile):
     try:
@@ -40,73 +85,435 @@ def __is_stdout(pfile):
 def basename(stream):
     if __is_stdout(stream):
         return "<stdout>"
+    elif not hasattr(stream, 'name'):
+        return "<stream>"
     else:
         return os.path.basename(stream.name)
 
 
 def generate_json_compdb(instream=None, proj_dir=os.getcwd(), exclude_files=[], add_predefined_macros=False,
-                         use_full_path=False, command_style=False):
+                         use_full_path=False, command_style=False, parser='bashlex', jobs=1,
+                         subst_jobs=1, subst_timeout=None, subst_nocache=[], macros_file=False, result=None):
     if not os.path.isdir(proj_dir):
         raise Error("Project dir '{}' does not exists!".format(proj_dir))
 
     logger.info("## Processing build commands from {}".format(basename(instream)))
     result = parse_build_log(instream, proj_dir, exclude_files, add_predefined_macros=add_predefined_macros,
-                             use_full_path=use_full_path, command_style=command_style)
+                             use_full_path=use_full_path, command_style=command_style, parser=parser, jobs=jobs,
+                             subst_jobs=subst_jobs, subst_timeout=subst_timeout, subst_nocache=subst_nocache,
+                             macros_file=macros_file, result=result)
     return result
 
 
-def write_json_compdb(compdb, outstream, force=False, pretty_output=True):
-    logger.info("## Writing compilation database with {} entries to {}".format(
-        len(compdb), basename(outstream)))
-
-    # We could truncate after reading, but here is easier to understand
-    if not __is_stdout(outstream):
-        outstream.seek(0)
-        outstream.truncate()
-    json.dump(compdb, outstream, indent=pretty_output)
+def _write_entries(compdb, outstream, pretty_output):
+    dumps, indent = (_dumps_pretty, ' ') if pretty_output else (_dumps_compact, '')
+    count = 0
+    outstream.write('[')
+    for entry in compdb:
+        outstream.write(',\n' if count else '\n')
+        outstream.write(indent + dumps(to_dict(entry)))
+        count += 1
+    outstream.write('\n]' if count else ']')
     outstream.write(os.linesep)
+    return count
 
 
-def load_json_compdb(outstream):
+def _same_content(stream, other, chunk_size=1 << 16):
+    stream.seek(0)
+    other.seek(0)
+    while True:
+        chunk = stream.read(chunk_size)
+        if chunk != other.read(chunk_size):
+            return False
+        if not chunk:
+            return True
+
+
+def _file_path(stream):
+    """Path of the file opened by stream, or None (e.g: for in-memory streams).
+       Symlinks are resolved, so that their target is replaced, not the link."""
+    name = getattr(stream, 'name', None)
+    return os.path.realpath(name) if isinstance(name, str) and os.path.isfile(name) else None
+
+
+def _replace_file(path, tmp):
+    try:
+        shutil.copymode(path, tmp)
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp, 0o666 & ~umask)
+    os.replace(tmp, path)
+
+
+def _has_content(path, stream):
     try:
-        if __is_stdout(outstream):
-            return []
-
-        # Read from beggining of file
-        outstream.seek(0)
-        compdb = json.load(outstream)
-        logger.info("## Loaded compilation database with {} entries from {}".format(
-            len(compdb), basename(outstream)))
-        return compdb
+        with open(path, 'r') as f:
+            return _same_content(stream, f)
+    except OSError:
+        return False
+
+
+def write_json_compdb(compdb, outstream, force=False, pretty_output=True):
+    """Write the entries of compdb, which may be any iterable, to outstream as
+       they are produced. Compact output has one unindented entry per line.
+       Entries are first written to a temporary file, so that compdb may still
+       be reading outstream while they are produced, and unless force is set,
+       outstream is left untouched if its contents would not change. Files are
+       then atomically replaced, so readers never see partially written ones.
+       Returns whether outstream was written."""
+    if __is_stdout(outstream):
+        count = _write_entries(compdb, outstream, pretty_output)
+        logger.info("## Writing compilation database with {} entries to {}".format(count, basename(outstream)))
+        return True
+
+    path = _file_path(outstream)
+    if path is None:
+        with tempfile.TemporaryFile('w+') as tmp:
+            count = _write_entries(compdb, tmp, pretty_output)
+            if not force and _same_content(tmp, outstream):
+                logger.info("## Compilation database {} is up to date".format(basename(outstream)))
+                return False
+            logger.info("## Writing compilation database with {} entries to {}".format(count, basename(outstream)))
+            tmp.seek(0)
+            outstream.seek(0)
+            outstream.truncate()
+            shutil.copyfileobj(tmp, outstream)
+            return True
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.' + os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'w+') as f:
+            count = _write_entries(compdb, f, pretty_output)
+            unchanged = not force and _has_content(path, f)
+        if unchanged:
+            logger.info("## Compilation database {} is up to date".format(basename(outstream)))
+            return False
+        logger.info("## Writing compilation database with {} entries to {}".format(count, basename(outstream)))
+        _replace_file(path, tmp)
+        return True
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+@contextmanager
+def _locked(outstream):
+    """Hold an advisory lock for the output file while updating it, so that concurrent
+       runs (e.g: for several build logs) can safely merge into the same database.
+       A separate lock file is used, since the output file itself gets replaced."""
+    path = _file_path(outstream)
+    if path is None or fcntl is None:
+        yield
+        return
+
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+@contextmanager
+def _reopened(outstream):
+    """Reopen the output file by path, since it may have been replaced by other
+       compiledb runs after outstream was opened."""
+    path = _file_path(outstream)
+    if path is None:
+        yield outstream
+        return
+
+    with open(path, 'r') as f:
+        yield f
+
+
+class _JSONArrayReader(object):
+    """Incrementally decodes the items of a JSON array from a text stream."""
+    _whitespace = json.decoder.WHITESPACE
+
+    def __init__(self, stream, chunk_size):
+        self._stream = stream
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+
+    def _fill(self):
+        chunk = self._stream.read(self._chunk_size)
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return len(chunk) > 0
+
+    def _next_char(self):
+        """Skip whitespace and return the next (not consumed) char, or '' at the end."""
+        while True:
+            self._pos = self._whitespace.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ''
+
+    def _value(self):
+        self._next_char()
+        while True:
+            try:
+                value, self._pos = self._decoder.raw_decode(self._buf, self._pos)
+                return value
+            except ValueError:
+                # Possibly a value split across chunks
+                if not self._fill():
+                    raise
+
+    def __iter__(self):
+        if self._next_char() != '[':
+            raise ValueError("Expecting '['")
+        self._pos += 1
+        if self._next_char() == ']':
+            return
+        while True:
+            yield self._value()
+            c = self._next_char()
+            self._pos += 1
+            if c == ']':
+                return
+            if c != ',':
+                raise ValueError("Expecting ',' or ']'")
+
+
+def iter_json_compdb(instream, chunk_size=1 << 16):
+    """Iterate over the entries of a compilation database, reading and decoding
+       it incrementally, so the whole document is never loaded in memory."""
+    if __is_stdout(instream):
+        return
+
+    # Read from beggining of file
+    instream.seek(0)
+    count = 0
+    try:
+        for entry in _JSONArrayReader(instream, chunk_size):
+            count += 1
+            yield entry
     except Exception as e:
-        logger.debug("## Failed to read previous {}: {}".format(basename(outstream), e))
-        return []
+        logger.debug("## Failed to read previous {}: {}".format(basename(instream), e))
+        return
+    logger.info("## Loaded compilation database with {} entries from {}".format(count, basename(instream)))
+
+
+def load_json_compdb(outstream):
+    return list(iter_json_compdb(outstream))
+
+
+class MergeStats(object):
+    """Counts of entries added, removed and updated by merge_compdb. If track_entries
+       is set, their keys are recorded as well, to be written as a delta file."""
+
+    def __init__(self, track_entries=False):
+        self.added = 0
+        self.removed = 0
+        self.updated = 0
+        self.unchanged = 0
+        self._entries = {'added': [], 'removed': [], 'updated': []} if track_entries else None
+
+    @property
+    def changed(self):
+        return self.added + self.removed + self.updated
+
+    def count(self, kind, entry=None):
+        setattr(self, kind, getattr(self, kind) + 1)
+        if self._entries is not None and entry is not None and kind in self._entries:
+            self._entries[kind].append({'directory': entry['directory'], 'file': entry['file']})
 
+    def delta(self):
+        """Keys (directory and file) of the added, removed and modified entries."""
+        return {
+            'added': self._entries['added'],
+            'removed': self._entries['removed'],
+            'modified': self._entries['updated'],
+        }
 
-def merge_compdb(compdb, new_compdb, check_files=True):
+    def __str__(self):
+        return "Added: {}, Removed: {}, Updated: {}, Unchanged: {}".format(
+            self.added, self.removed, self.updated, self.unchanged)
+
+
+def _prefetched(compdb, files, gen_key):
+    """Iterate over compdb entries, prefetching the listings of their directories
+       in windows of MERGE_CHUNK_SIZE entries, if a FileExistenceCache is given."""
+    if files is None:
+        yield from compdb
+        return
+    compdb = iter(compdb)
+    while True:
+        chunk = list(islice(compdb, MERGE_CHUNK_SIZE))
+        if not chunk:
+            return
+        files.prefetch(gen_key(c) for c in chunk if 'file' in c)
+        yield from chunk
+
+
+def merge_compdb(compdb, new_compdb, check_files=True, stats=None, files=None, keep_old=True):
+    """Merge new_compdb into compdb, which may be a stream of entries (see iter_json_compdb).
+       Entries keep their order, updated ones in place and the new ones at the end.
+       Without keep_old, only new_compdb entries are kept, in their order, but compdb is
+       still compared against them. If a MergeStats is given, it is updated as the merged
+       entries are produced. Files existence is checked through a FileExistenceCache,
+       which may be shared."""
     def gen_key(entry):
         if 'directory' in entry:
             return os.path.join(entry['directory'], entry['file'])
         return entry['directory']
 
     def check_file(path):
-        return True if not check_files else os.path.exists(path)
+        return True if not check_files else files.exists(path)
+
+    if stats is None:
+        stats = MergeStats()
+    if files is None:
+        files = FileExistenceCache()
 
-    orig = {gen_key(c): c for c in compdb if 'file' in c}
     new = {gen_key(c): c for c in new_compdb if 'file' in c}
-    orig.update(new)
-    return [v for k, v in orig.items() if check_file(k)]
+    if check_files:
+        files.prefetch(new)
+
+    seen = set()
+    for c in _prefetched(compdb, files if check_files else None, gen_key):
+        if 'file' not in c:
+            stats.count('removed')
+            continue
+        key = gen_key(c)
+        if key in seen:
+            stats.count('removed')
+            continue
+        seen.add(key)
+        if not check_file(key):
+            stats.count('removed', c)
+            continue
+        n = new.get(key)
+        if n is None:
+            if not keep_old:
+                stats.count('removed', c)
+                continue
+            stats.count('unchanged')
+            n = c
+        elif n == c:
+            stats.count('unchanged')
+        else:
+            stats.count('updated', c)
+        if keep_old:
+            yield n
+
+    for key, c in new.items():
+        if key in seen and keep_old or not check_file(key):
+            continue
+        if key not in seen:
+            stats.count('added', c)
+        yield c
+
+
+def write_delta(stats, path):
+    """Write the keys of the entries changed by a merge to a JSON file."""
+    logger.info("## Writing compilation database delta to {}".format(path))
+    try:
+        cache.write_atomically(path, json.dumps(stats.delta(), indent=1) + os.linesep)
+    except OSError as e:
+        raise Error("Failed to write delta file {}: {}".format(path, e))
+
+
+def update_json_compdb(new_compdb, outfile, overwrite=False, strict=False, compact=False, delta=None,
+                       server=None):
+    """Merge new_compdb entries into the compilation database in outfile (unless
+       overwriting it) and write it, optionally along with a delta file. If the
+       path of a compiledb server socket is given, entries are sent to it instead."""
+    if server is not None:
+        stats = MergeStats()
+        # Only the new entries are checked, the server checks its own ones when persisting them
+        counts = send_entries(server, merge_compdb([], new_compdb, strict, stats), overwrite)
+        stats.added, stats.updated, stats.unchanged = counts['added'], counts['updated'], counts['unchanged']
+        logger.info("## Sent entries to compiledb server {}. {}".format(server, stats))
+        return
+    stats = MergeStats(track_entries=delta is not None)
+    with _locked(outfile), _reopened(outfile) as current:
+        # The previous entries are only needed to compute the delta when overwriting
+        compdb = [] if overwrite and delta is None else iter_json_compdb(current)
+        compdb = merge_compdb(compdb, new_compdb, strict, stats, keep_old=not overwrite)
+        write_json_compdb(compdb, outfile, pretty_output=not compact)
+    logger.info("## Merged compilation database entries. {}".format(stats))
+    if delta is not None:
+        write_delta(stats, delta)
+
+
+class _FollowFlusher(object):
+    """Merges the entries parsed so far from a followed build log into the
+       compilation database, every `entries` new entries or, while waiting for
+       new lines, every `interval` seconds. It is used as FollowedStream's
+       on_poll callback, so flushes happen between lines."""
+
+    def __init__(self, result, outfile, macros_file, interval, entries, overwrite, strict, compact, server):
+        self.result = result
+        self.outfile = outfile
+        self.macros_file = macros_file
+        self.interval = interval
+        self.entries = entries
+        self.overwrite = overwrite
+        self.strict = strict
+        self.compact = compact
+        self.server = server
+        self.flushed = 0
+        self.last_flush = time.monotonic()
+
+    def __call__(self, idle=False):
+        new_entries = len(self.result.compdb) - self.flushed
+        if new_entries <= 0:
+            return
+        if ((self.entries and new_entries >= self.entries) or
+                (idle and time.monotonic() - self.last_flush >= self.interval)):
+            self.flush()
+
+    def flush(self):
+        resolve_predefined_macros(self.result, self.macros_file)
+        new_compdb = self.result.compdb[self.flushed:]
+        if not new_compdb and not self.overwrite and self.flushed:
+            return
+        logger.info("## Flushing {} new entries".format(len(new_compdb)))
+        # Only the first flush may overwrite the existing database
+        update_json_compdb(new_compdb, self.outfile, overwrite=self.overwrite, strict=self.strict,
+                           compact=self.compact, server=self.server)
+        self.overwrite = False
+        self.flushed += len(new_compdb)
+        self.last_flush = time.monotonic()
 
 
 def generate(infile, outfile, build_dir, exclude_files, overwrite=False, strict=False,
-             add_predefined_macros=False, use_full_path=False, command_style=False):
+             add_predefined_macros=False, use_full_path=False, command_style=False, parser='bashlex', jobs=1,
+             subst_jobs=1, subst_timeout=None, subst_nocache=[], macros_file=False, compact=False, delta=None,
+             follow=False, flush_interval=10, flush_entries=1000, follow_timeout=None, server=None):
+    result = flusher = None
+    if follow:
+        # Keep parsing the build log as it grows, writing the database as we go.
+        # Lines are parsed serially and without lookahead (see process_lines), as
+        # both parallel parsing and prefetching substitutions read lines ahead.
+        result = ParsingResult()
+        flusher = _FollowFlusher(result, outfile, macros_file, flush_interval, flush_entries,
+                                 overwrite=overwrite, strict=strict, compact=compact, server=server)
+        infile = FollowedStream(infile, timeout=follow_timeout, on_poll=flusher)
+        jobs = subst_jobs = 1
     try:
-        r = generate_json_compdb(infile, proj_dir=build_dir, exclude_files=exclude_files,
-                                 add_predefined_macros=add_predefined_macros, use_full_path=use_full_path,
-                                 command_style=command_style)
-        compdb = [] if overwrite else load_json_compdb(outfile)
-        compdb = merge_compdb(compdb, r.compdb, strict)
-        write_json_compdb(compdb, outfile)
+        try:
+            r = generate_json_compdb(infile, proj_dir=build_dir, exclude_files=exclude_files,
+                                     add_predefined_macros=add_predefined_macros, use_full_path=use_full_path,
+                                     command_style=command_style, parser=parser, jobs=jobs, subst_jobs=subst_jobs,
+                                     subst_timeout=subst_timeout, subst_nocache=subst_nocache,
+                                     macros_file=macros_file, result=result)
+        except KeyboardInterrupt:
+            if flusher is None:
+                raise
+            logger.info("## Interrupted, writing the entries parsed so far")
+        if flusher is not None:
+            flusher.flush()
+        else:
+            update_json_compdb(r.compdb, outfile, overwrite=overwrite, strict=strict, compact=compact, delta=delta,
+                               server=server)
         logger.info("## Done.")
         return True
     except Error as e:
@@ -0,0 +1,108 @@
+#
+#   compiledb: Tool for generating LLVM Compilation Database
+#   files for make-based build systems.
+#
+#   Copyright (c) 2017 Nick Diego Yamane <nick.diego@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Simple persistent key/value cache, stored as JSON files under
+$XDG_CACHE_HOME/compiledb (~/.cache/compiledb by default)."""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+_logger = logging.getLogger(__name__)
+
+# Subdirs holding files referenced from compilation databases (e.g: the @file
+# macros response files), which clearing the cache must not break
+KEPT_SUBDIRS = ("macros-files",)
+
+
+def cache_dir(*subdirs):
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'compiledb', *subdirs)
+
+
+def _normalize(key):
+    # Make sure keys compare equal after a round-trip through JSON (e.g: tuples)
+    return json.loads(json.dumps(key, sort_keys=True))
+
+
+def _entry_path(namespace, key):
+    digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir(namespace), digest + '.json')
+
+
+def load(namespace, key):
+    """Return the value stored for key, or None if there is no such entry."""
+    key = _normalize(key)
+    try:
+        with open(_entry_path(namespace, key), 'r') as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(entry, dict) or entry.get('key') != key:
+        return None
+    return entry.get('value')
+
+
+def store(namespace, key, value):
+    """Store value for key. Failures are logged and otherwise ignored."""
+    key = _normalize(key)
+    path = _entry_path(namespace, key)
+    try:
+        write_atomically(path, json.dumps({'key': key, 'value': value}))
+    except OSError as e:
+        _logger.debug("Failed to write cache entry {}: {}".format(path, e))
+
+
+def write_atomically(path, content):
+    """Write content to path through a temporary file, so concurrent
+       readers never see a partially written file."""
+    dirname = os.path.dirname(path)
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def clear():
+    """Remove all cache entries, but for the files in KEPT_SUBDIRS."""
+    path = cache_dir()
+    _logger.info("## Clearing cache {}".format(path))
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return
+    for name in names:
+        if name in KEPT_SUBDIRS:
+            continue
+        entry = os.path.join(path, name)
+        if os.path.isdir(entry) and not os.path.islink(entry):
+            shutil.rmtree(entry, ignore_errors=True)
+        else:
+            try:
+                os.remove(entry)
+            except OSError:
+                pass
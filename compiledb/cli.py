@@ -25,8 +25,10 @@ import os
 import sys
 import logging
 
-from . import generate
-from .commands import make
+from . import cache, generate
+from .commands import make, serve, wrap
+from .compiler import load_toolchain_manifest
+from .parser import PARSERS
 
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 
@@ -36,7 +38,8 @@ class Options(object):
     shared by all compiledb subcommands"""
 
     def __init__(self, infile, outfile, build_dir, exclude_files, no_build,
-                 verbose, overwrite, strict, add_predefined_macros, use_full_path, command_style):
+                 verbose, overwrite, strict, add_predefined_macros, use_full_path, command_style, parser,
+                 jobs, subst_jobs, subst_timeout, subst_nocache, macros_file, compact, delta, server):
         self.infile = infile
         self.outfile = outfile
         self.build_dir = build_dir
@@ -48,6 +51,28 @@ class Options(object):
         self.add_predefined_macros = add_predefined_macros
         self.use_full_path = use_full_path
         self.command_style = command_style
+        self.parser = parser
+        self.jobs = jobs
+        self.subst_jobs = subst_jobs
+        self.subst_timeout = subst_timeout
+        self.subst_nocache = subst_nocache
+        self.macros_file = macros_file
+        self.compact = compact
+        self.delta = delta
+        self.server = server
+
+
+def clear_cache(ctx, param, value):
+    if value:
+        cache.clear()
+
+
+def load_toolchain(ctx, param, value):
+    if value is not None:
+        try:
+            load_toolchain_manifest(value)
+        except ValueError as e:
+            raise click.BadParameter("Invalid toolchain manifest: {}".format(e))
 
 
 @click.group(context_settings=CONTEXT_SETTINGS, invoke_without_command=True)
@@ -69,32 +94,89 @@ class Options(object):
               help='Print verbose messages.')
 @click.option('-f', '--overwrite', is_flag=True, default=False,
               help='Overwrite compile_commands.json instead of just updating it.')
+@click.option('--compact', is_flag=True, default=False,
+              help='Write a compact compilation database, with one entry per line, instead of pretty printing it.')
+@click.option('--delta', type=click.Path(dir_okay=False),
+              help='Also write a JSON file listing the entries (directory and file) added, removed and '
+              'modified in the compilation database.')
+@click.option('--server', type=click.Path(dir_okay=False), envvar='COMPILEDB_SERVER',
+              help='Send the entries to the compiledb server listening on this unix socket (see the serve '
+              'command), which merges them into its database, instead of updating the output file. '
+              'Can also be set through $COMPILEDB_SERVER.')
+@click.option('--follow', is_flag=True, default=False,
+              help='Keep parsing the build log as it grows (like tail -f), periodically merging the new '
+              'entries into the compilation database, until interrupted or --follow-timeout expires.')
+@click.option('--flush-interval', type=click.FloatRange(min=0), default=10, show_default=True,
+              help='With --follow, seconds between writes of the new entries while waiting for new lines.')
+@click.option('--flush-entries', type=click.IntRange(min=0), default=1000, show_default=True,
+              help='With --follow, number of new entries triggering a write (0 to disable).')
+@click.option('--follow-timeout', type=click.FloatRange(min=0),
+              help='With --follow, stop once the build log did not grow for this many seconds.')
 @click.option('-S', '--no-strict', is_flag=True, default=False,
               help='Do not check if source files exist in the file system.')
 @click.option('-m', '--macros', 'add_predefined_macros', is_flag=True, default=False,
               help='Add predefined compiler macros to the compilation database. Make sure that ' +
               'all of the used compilers are in your $PATH')
+@click.option('--macros-file', is_flag=True, default=False,
+              help='Write the predefined compiler macros once per compiler to a response file in the '
+              'compiledb cache dir, referenced from each entry as @file, instead of inlining them. Implies -m.')
+@click.option('--clear-cache', is_flag=True, expose_value=False, callback=clear_cache,
+              help='Clear the compiledb cache (e.g: predefined compiler macros) before running. The '
+              'macros response files written with --macros-file are kept.')
 @click.option('--full-path', 'use_full_path', is_flag=True, default=False,
               help='Write full path to the compiler executable.')
+@click.option('--toolchain', type=click.File('r'), expose_value=False, callback=load_toolchain,
+              help='JSON file mapping compiler names to the full path of their executables, '
+              'used instead of looking them up in $PATH.')
 @click.option('--command-style', is_flag=True, default=False,
               help='Output compilation database with single "command" '
               'string rather than the default "arguments" list of strings.')
+@click.option('--parser', type=click.Choice(PARSERS), default='bashlex', show_default=True,
+              help='Engine used to parse build commands. "fast" uses a lightweight tokenizer, '
+              'falling back to bashlex only for complex shell constructs.')
+@click.option('-j', '--jobs', type=click.IntRange(min=0), default=1, show_default=True,
+              help='Number of processes used to parse the build log (0 for one per CPU core).')
+@click.option('--subst-jobs', type=click.IntRange(min=1), default=1, show_default=True,
+              help='Maximum number of command substitutions (e.g: $(pkg-config --cflags foo)) run concurrently.')
+@click.option('--subst-timeout', type=click.FloatRange(min=0), default=None,
+              help='Timeout, in seconds, for each command substitution (Default: none, 0 disables it as well).')
+@click.option('--subst-nocache', multiple=True,
+              help='Regular expressions for command substitutions whose output must not be cached '
+              '(e.g: non-deterministic commands).')
 @click.pass_context
-def cli(ctx, infile, outfile, build_dir, exclude_files, no_build, verbose, overwrite, no_strict, add_predefined_macros,
-        use_full_path, command_style):
+def cli(ctx, infile, outfile, build_dir, exclude_files, no_build, verbose, overwrite, compact, delta, server, follow,
+        flush_interval, flush_entries, follow_timeout, no_strict, add_predefined_macros, macros_file, use_full_path,
+        command_style, parser, jobs, subst_jobs, subst_timeout, subst_nocache):
     """Clang's Compilation Database generator for make-based build systems.
        When no subcommand is used it will parse build log/commands and generates
        its corresponding Compilation database."""
     log_level = logging.DEBUG if verbose else logging.ERROR
     logging.basicConfig(level=log_level, format=None)
+    if follow:
+        if ctx.invoked_subcommand is not None:
+            raise click.UsageError("--follow can only be used when parsing a build log")
+        if delta is not None:
+            raise click.UsageError("--follow can't be used along with --delta")
+        if outfile.name == sys.stdout.name:
+            raise click.UsageError("--follow can't write to stdout")
+    if server is not None and delta is not None:
+        raise click.UsageError("--server can't be used along with --delta")
     if ctx.invoked_subcommand is None:
-        done = generate(infile, outfile, build_dir, exclude_files, overwrite, not no_strict, add_predefined_macros,
-                        use_full_path, command_style)
+        done = generate(infile, outfile, build_dir, exclude_files, overwrite=overwrite, strict=not no_strict,
+                        add_predefined_macros=add_predefined_macros, use_full_path=use_full_path,
+                        command_style=command_style, parser=parser, jobs=jobs, subst_jobs=subst_jobs,
+                        subst_timeout=subst_timeout, subst_nocache=subst_nocache, macros_file=macros_file,
+                        compact=compact, delta=delta, follow=follow, flush_interval=flush_interval,
+                        flush_entries=flush_entries, follow_timeout=follow_timeout, server=server)
         exit(0 if done else 1)
     else:
         ctx.obj = Options(infile, outfile, build_dir, exclude_files, no_build, verbose, overwrite, not no_strict,
-                          add_predefined_macros, use_full_path, command_style)
+                          add_predefined_macros, use_full_path, command_style, parser, jobs, subst_jobs,
+                          subst_timeout, subst_nocache, macros_file, compact, delta, server)
 
 
 # Add subcommands
 cli.add_command(make.command)
+cli.add_command(serve.command)
+cli.add_command(wrap.wrap_command)
+cli.add_command(wrap.collect_command)
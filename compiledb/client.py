@@ -0,0 +1,96 @@
+#
+#   compiledb: Tool for generating LLVM Compilation Database
+#   files for make-based build systems.
+#
+#   Copyright (c) 2017 Nick Diego Yamane <nick.diego@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Client side of the compiledb server (see `compiledb serve`).
+
+Requests and replies are JSON objects, one per line, sent over a unix
+socket. Requests have a "command" key, failed ones are replied with an
+"error" key."""
+import json
+import socket
+from itertools import islice
+
+from compiledb.entry import to_dict
+from compiledb.parser import Error
+
+# Number of entries sent in each update request
+BATCH_SIZE = 4096
+
+
+class Connection(object):
+    def __init__(self, path):
+        self.path = path
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._sock.connect(path)
+        except OSError as e:
+            self._sock.close()
+            raise Error("Failed to connect to compiledb server at {}: {}".format(path, e))
+        self._stream = self._sock.makefile('rw', encoding='utf-8')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._stream.close()
+        self._sock.close()
+
+    def request(self, command, **args):
+        args['command'] = command
+        try:
+            self._stream.write(json.dumps(args) + '\n')
+            self._stream.flush()
+            reply = self._stream.readline()
+        except OSError as e:
+            raise Error("Failed to send request to compiledb server at {}: {}".format(self.path, e))
+        if not reply:
+            raise Error("Connection to compiledb server at {} closed".format(self.path))
+        reply = json.loads(reply)
+        if 'error' in reply:
+            raise Error("compiledb server at {}: {}".format(self.path, reply['error']))
+        return reply
+
+
+def send_entries(path, entries, overwrite=False):
+    """Send entries to the server at path, to be merged into its database, in
+       batches of BATCH_SIZE. Returns the counts of entries added, updated and
+       unchanged. With overwrite, the server drops its previous entries first."""
+    counts = {'added': 0, 'updated': 0, 'unchanged': 0}
+    entries = iter(entries)
+    with Connection(path) as conn:
+        while True:
+            batch = [to_dict(e) for e in islice(entries, BATCH_SIZE)]
+            if not batch and not overwrite:
+                break
+            reply = conn.request('update', entries=batch, overwrite=overwrite)
+            for kind in counts:
+                counts[kind] += reply[kind]
+            overwrite = False
+            if not batch:
+                break
+    return counts
+
+
+def request(path, command, **args):
+    """Send a single request (e.g: 'flush', 'status' or 'stop') to the server at path."""
+    with Connection(path) as conn:
+        return conn.request(command, **args)
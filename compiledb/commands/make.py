@@ -1,50 +1,103 @@
 import click
+import hashlib
+import json
+import logging
 import os
+import re
 import stat
 import tempfile
 
-from subprocess import call, PIPE
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import chain
+from subprocess import call, CalledProcessError, DEVNULL, PIPE
 from sys import exit, stdout, stderr
 
-from compiledb import generate
-from compiledb.utils import popen, cmd_join
+from compiledb import cache, generate, generate_json_compdb, update_json_compdb
+from compiledb.entry import to_dict
+from compiledb.parser import Error
+from compiledb.utils import popen, run_cmd, cmd_join, cmd_quote
 
+logger = logging.getLogger(__name__)
 
-class AutoconfMockScript:
+# Makes make (and sub-makes, since --eval is passed down through MAKEFLAGS) report
+# its directory before the makefiles it reads, which are logged by --debug=v
+makefiles_dir_eval = "--eval=$(info compiledb: reading makefiles in $(CURDIR))"
+makefiles_dir_regex = re.compile(r"^compiledb: reading makefiles in (?P<dir>.*)$")
+reading_makefile_regex = re.compile(r"^Reading makefile [`'](?P<file>.*?)'")
+
+# Environment variables not affecting the build, ignored in dry run cache keys
+volatile_env = {"_", "OLDPWD", "SHLVL"}
+
+
+class RegenerationRule:
+    """Commands regenerating the build system (e.g: makefiles), as shell patterns
+    matched against the whole command. A rule is only enabled when any of its
+    marker files is found in the directories make is run in."""
+    def __init__(self, name, patterns, markers):
+        self.name = name
+        self.patterns = patterns
+        self.markers = markers
+
+    def enabled(self, dirs):
+        return any(os.path.exists(os.path.join(d, m)) for d in dirs for m in self.markers)
+
+
+# Rules for the commands skipped during dry runs. Others may be added here.
+regeneration_rules = [
+    # config.status reruns, as well as autoconf, automake, aclocal, etc,
+    # invoked through the 'missing' script, as done by automake rules
+    RegenerationRule("autoconf", ["*config.status*", "*/missing *"], ["config.status"]),
+    RegenerationRule("automake", ["*automake-[0-9]*", "*aclocal-[0-9]*"], ["config.status", "Makefile.in"]),
+    RegenerationRule("libtool", ["*libtoolize*"], ["libtool"]),
+    RegenerationRule("cmake", ["*--check-build-system*"], ["CMakeCache.txt"]),
+]
+
+
+class RegenerationMockScript:
     """This hack is intended to make it possible/feasible
     to use "make --dry-run --always-make" to speed up the compilation
-    commands extraction with autoconf/automake based build systems.
-    Without this ugly hack, particularly `--always-make` causes the
-    autoconf's configure script to be executed to every make target,
-    severely slowing down the process.
-    To work around this issue we use a mock/empty script to be used
-    in place of config.status and missing is they exist.
+    commands extraction with autoconf, automake, CMake, etc, based
+    build systems. Without it, particularly `--always-make` causes
+    makefiles to be remade (e.g: configure to be executed) for every
+    make target, severely slowing down the process, since make still
+    runs the commands that remake makefiles during dry runs.
+    To work around this issue we use a mock shell script, used as
+    SHELL, which skips the commands matching the enabled regeneration
+    rules and logs them, so that they can be counted.
     """
-    def __init__(self, verbose):
+    def __init__(self, verbose, dirs=()):
         self.verbose = verbose
+        self.dirs = dirs or [os.curdir]
         self.path = None
-        self.mock_script = """#!/bin/bash
-            ## Auto generated by compiledb. Do not modify!
-            ## https://github.com/nickdiego/compiledb
-            case "$*" in
-                ./config.status*|*/missing*)
-                    #echo "Skipping $@" >>/tmp/compiledb.log
-                    exit 0
-                    ;;
-                *)
-                    shift && test $# -gt 0 && /bin/sh -c "$@"
-                    exit $?
-                    ;;
-            esac
-            """
+        self.log_path = None
+        self.skipped = {}
+
+    def _script(self, rules):
+        cases = ''.join("""
+    {patterns})
+        echo {name} >>{log}
+        exit 0
+        ;;""".format(patterns='|'.join(p.replace(' ', '\\ ') for p in r.patterns),
+                     name=r.name, log=cmd_quote(self.log_path)) for r in rules)
+        return """#!/bin/sh
+## Auto generated by compiledb. Do not modify!
+## https://github.com/nickdiego/compiledb
+case "$*" in{cases}
+esac
+exec /bin/sh "$@"
+""".format(cases=cases)
 
     def __enter__(self):
-        if not os.path.isfile("config.status"):
+        rules = [r for r in regeneration_rules if r.enabled(self.dirs)]
+        if not rules:
             return self
         try:
+            fd, self.log_path = tempfile.mkstemp(suffix='.log')
+            os.close(fd)
             fd, tmp = tempfile.mkstemp()
             with os.fdopen(fd, 'w') as out:
-                out.write(self.mock_script)
+                out.write(self._script(rules))
             os.chmod(tmp, stat.S_IEXEC | stat.S_IREAD)
             self.path = tmp
             return self
@@ -53,48 +106,290 @@ class AutoconfMockScript:
             raise e
 
     def __exit__(self, exc_type, exc_value, traceback):
+        self.report()
         self.cleanup()
 
+    def report(self):
+        if not self.log_path or not os.path.isfile(self.log_path):
+            return
+        with open(self.log_path) as log:
+            for name in log.read().split():
+                self.skipped[name] = self.skipped.get(name, 0) + 1
+        if self.skipped:
+            logger.info("## Skipped {} build system regeneration commands ({})".format(
+                sum(self.skipped.values()), ', '.join('{}: {}'.format(k, v) for k, v in sorted(self.skipped.items()))))
+
     def cleanup(self):
-        if not self.path:
+        if not self.path and not self.log_path:
             return
         if self.verbose:
-            print("Cleaning up autoconf mock resources..")
-        if os.path.isfile(self.path):
-            os.remove(self.path)
+            print("Cleaning up regeneration mock resources..")
+        for path in (self.path, self.log_path):
+            if path and os.path.isfile(path):
+                os.remove(path)
+
+
+def make_dirs(make_args):
+    """Directories make is run in, according to the -C options in make_args."""
+    dirs = []
+    args = iter(make_args)
+    for arg in args:
+        if arg in ("-C", "--directory"):
+            d = next(args, None)
+        elif arg.startswith("--directory="):
+            d = arg[len("--directory="):]
+        elif arg.startswith("-C"):
+            d = arg[2:]
+        else:
+            continue
+        # Relative -C options are relative to the previous ones
+        dirs = [os.path.join(dirs[-1], d) if dirs else d]
+    return dirs
+
+
+class TeeStream:
+    """Iterates over the lines of a stream (e.g: the real build output),
+    echoing them to stdout as they are read, so that they can be shown
+    and parsed at the same time."""
+    def __init__(self, stream, name):
+        self.stream = stream
+        self.name = name
+
+    def __iter__(self):
+        for line in self.stream:
+            click.echo(line, nl=False)
+            yield line
+
+
+class MakefilesRecorder:
+    """Iterates over the lines of make's output (see makefiles_dir_eval), recording
+    the makefiles read by make and its sub-makes and hiding them from the parser."""
+    def __init__(self, stream, build_dir):
+        self.stream = stream
+        self.name = getattr(stream, 'name', None)
+        self.makefiles = []
+        self._dir = build_dir
+
+    def __iter__(self):
+        for line in self.stream:
+            m = reading_makefile_regex.match(line)
+            if m:
+                self.makefiles.append(os.path.normpath(os.path.join(self._dir, m.group('file'))))
+                continue
+            m = makefiles_dir_regex.match(line)
+            if m:
+                self._dir = m.group('dir')
+                continue
+            yield line
+
+
+def hash_file(path):
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def dry_run_cache_key(cmd, parse_args):
+    env = {k: v for k, v in os.environ.items() if k not in volatile_env}
+    return {
+        "cmd": cmd,
+        "cwd": os.getcwd(),
+        "options": parse_args,
+        "env": hashlib.sha1(json.dumps(env, sort_keys=True).encode('utf-8')).hexdigest(),
+    }
+
+
+def load_cached_dry_run(key):
+    """Return the entries of a cached dry run, if none of its makefiles changed."""
+    cached = cache.load("make", key)
+    if cached is None:
+        return None
+    for path, digest in cached["makefiles"].items():
+        if hash_file(path) != digest:
+            logger.info("## Makefile {} changed since the cached dry run".format(path))
+            return None
+    return cached["entries"]
+
+
+def store_dry_run(key, makefiles, entries):
+    if not makefiles:
+        logger.info("## No makefiles reported by make, not caching dry run")
+        return
+    cache.store("make", key, {
+        "makefiles": {path: hash_file(path) for path in makefiles},
+        "entries": [to_dict(e) for e in entries],
+    })
+
+
+def supports_output_sync(make_cmd):
+    """Whether make supports --output-sync, added in GNU Make 4.0."""
+    try:
+        version = run_cmd([make_cmd, "--version"], stderr=DEVNULL)
+    except (OSError, CalledProcessError):
+        return False
+    m = re.match(r"GNU Make (\d+)\.", version)
+    return m is not None and int(m.group(1)) >= 4
+
+
+@contextmanager
+def dry_run(cmd, mock_script):
+    """Run a make dry run command, using the mock script as SHELL if needed, and
+    yield its process, whose output is to be read from stdout. Once done, any
+    output left is drained, in case parsing it failed, so that make can finish
+    and its returncode be set."""
+    if mock_script.path:
+        cmd = cmd + ["SHELL={}".format(mock_script.path)]
+    pipe = popen(cmd_join(cmd), stdout=PIPE)
+    try:
+        yield pipe
+    finally:
+        for line in pipe.stdout:
+            pass
+        pipe.wait()
+
+
+def split_args(args):
+    """Split the main command options into generate_json_compdb and update_json_compdb ones."""
+    write_args = {k: args.pop(k) for k in ('outfile', 'overwrite', 'strict', 'compact', 'delta', 'server')}
+    del args['infile']
+    args['proj_dir'] = args.pop('build_dir')
+    return args, write_args
+
+
+def generate_cached(args, make_cmd, flags, make_args, mock_script, refresh):
+    """Same as generate() for a make dry run, but skipping it and reusing the entries
+    from the previous one if none of the makefiles read by make has changed since."""
+    parse_args, write_args = split_args(args)
+    key = dry_run_cache_key([make_cmd] + list(make_args), parse_args)
+
+    try:
+        entries = None if refresh else load_cached_dry_run(key)
+        if entries is not None:
+            logger.info("## Makefiles unchanged, using cached dry run results")
+        else:
+            cmd = [make_cmd] + flags + ["--debug=v", makefiles_dir_eval] + list(make_args)
+            with dry_run(cmd, mock_script) as make:
+                recorder = MakefilesRecorder(make.stdout, parse_args['proj_dir'])
+                entries = generate_json_compdb(recorder, **parse_args).compdb
+            # The results of a failed (i.e: partial) dry run would be reused until the makefiles change
+            if make.returncode == 0:
+                store_dry_run(key, recorder.makefiles, entries)
+            else:
+                logger.warning("## {} exited with status {}, not caching the dry run results".format(
+                    make_cmd, make.returncode))
+        update_json_compdb(entries, **write_args)
+        logger.info("## Done.")
+        return True
+    except Error as e:
+        logger.error(e)
+        return False
+
+
+def generate_dirs(args, make_cmd, flags, make_args, dirs, parallel, mock_script):
+    """Run make dry runs for several directories concurrently, parsing each output
+    as it arrives, and merge them into the database in the order dirs are given."""
+    args, write_args = split_args(args)
+
+    def dry_run_dir(d):
+        with dry_run([make_cmd] + flags + ["-C", d] + list(make_args), mock_script) as make:
+            return generate_json_compdb(make.stdout, **args).compdb
+
+    try:
+        with ThreadPoolExecutor(parallel or os.cpu_count()) as executor:
+            results = list(executor.map(dry_run_dir, dirs))
+        update_json_compdb(chain.from_iterable(results), **write_args)
+        logger.info("## Done.")
+        return True
+    except Error as e:
+        logger.error(e)
+        return False
 
 
 @click.command(name='make', context_settings=dict(ignore_unknown_options=True))
 @click.option('-c', '--cmd', 'make_cmd', nargs=1, required=False,
               help="Command to be used as make executable.")
+@click.option('--single-pass', is_flag=True, default=False,
+              help="Parse the build output, instead of running make again in dry-run mode "
+              "after building. Commands hidden by the build (e.g: silent rules) are missed.")
+@click.option('--dir', 'dirs', multiple=True, type=click.Path(exists=True, file_okay=False),
+              help="Directory to run make in (as make -C DIR). Can be repeated, so that the dry runs for "
+              "several directories are run concurrently and merged into a single database.")
+@click.option('--parallel', type=click.IntRange(min=1), default=None,
+              help="Maximum number of concurrent make dry runs when using --dir (Default: number of CPUs).")
+@click.option('--cache', 'use_cache', is_flag=True, default=False,
+              help="Reuse the results of the previous dry run, instead of running it again, when none of the "
+              "makefiles read by make has changed. Changes to source lists computed by make (e.g: with "
+              "$(wildcard) or $(shell)) are not detected. Requires GNU Make >= 3.82.")
+@click.option('--refresh-cache', is_flag=True, default=False,
+              help="Run the dry run even if its cached results are up to date, and cache them. Implies --cache.")
+@click.option('--dry-run-jobs', type=click.IntRange(min=1), default=1,
+              help="Number of jobs for the make dry run (as make -jN --output-sync=recurse, which keeps the "
+              "output of each sub-make together). Requires GNU Make >= 4.0, otherwise it runs serially.")
 @click.argument('make_args', nargs=-1, type=click.UNPROCESSED)
 @click.pass_context
-def command(ctx, make_cmd, make_args):
+def command(ctx, make_cmd, single_pass, dirs, parallel, use_cache, refresh_cache, dry_run_jobs, make_args):
     """Generates compilation database file for an arbitrary GNU Make command.
      Acts like a make wrapper, forwarding all MAKE_ARGS to make command"""
     make_cmd = make_cmd or 'make'
-    logging_mode_flags = "-Bnkw"
+    logging_mode_flags = ["-Bnkw"]
 
-    options = ctx.obj
+    args = vars(ctx.obj)
+    no_build = args.pop('no_build')
+    verbose = args.pop('verbose')
 
-    if not options.no_build:
-        cmd = [make_cmd] + list(make_args)
-        print("## Building [{}]...".format(' '.join(cmd)))
-        ret = call(cmd, stdout=stdout, stderr=stderr)
-        print()
-        if ret != 0:
-            exit(1)
+    use_cache = use_cache or refresh_cache
+    if single_pass and len(dirs) > 1:
+        raise click.UsageError("--single-pass can't be used with multiple --dir")
+    if use_cache and len(dirs) > 1:
+        raise click.UsageError("--cache can't be used with multiple --dir")
+    mock_dirs = dirs or make_dirs(make_args)
+    if len(dirs) == 1:
+        make_args = ("-C", dirs[0]) + make_args
+        dirs = ()
 
-    done = False
-    args = vars(options)
-    del args['no_build']
-    with AutoconfMockScript(options.verbose) as mock_script:
-        cmd = [make_cmd, logging_mode_flags] + list(make_args)
-        if mock_script.path:
-            cmd.append("SHELL={}".format(mock_script.path))
+    if single_pass and not no_build:
+        # Build once, using -w to keep track of the working directory
+        cmd = [make_cmd, "-w"] + list(make_args)
+        print("## Building [{}]...".format(' '.join(cmd)), flush=True)
         pipe = popen(cmd_join(cmd), stdout=PIPE)
-        options.infile = pipe.stdout
-        del args['verbose']
+        args['infile'] = TeeStream(pipe.stdout, "<{} output>".format(os.path.basename(make_cmd)))
         done = generate(**args)
-        pipe.wait()
+        for line in args['infile']:
+            pass  # In case generate gave up early, let the build finish
+        ret = pipe.wait()
+        print()
+        exit(0 if done and ret == 0 else 1)
+
+    if dry_run_jobs > 1:
+        if supports_output_sync(make_cmd):
+            logging_mode_flags += ["-j{}".format(dry_run_jobs), "--output-sync=recurse"]
+        else:
+            logger.warning("## {} does not support --output-sync, running the dry run serially".format(make_cmd))
+
+    if not no_build:
+        for d in dirs or [None]:
+            cmd = [make_cmd] + (["-C", d] if d else []) + list(make_args)
+            print("## Building [{}]...".format(' '.join(cmd)))
+            ret = call(cmd, stdout=stdout, stderr=stderr)
+            print()
+            if ret != 0:
+                exit(1)
+
+    if dirs:
+        with RegenerationMockScript(verbose, dirs) as mock_script:
+            done = generate_dirs(args, make_cmd, logging_mode_flags, make_args, dirs, parallel, mock_script)
+        exit(0 if done else 1)
+
+    if use_cache:
+        with RegenerationMockScript(verbose, mock_dirs) as mock_script:
+            done = generate_cached(args, make_cmd, logging_mode_flags, make_args, mock_script, refresh_cache)
+        exit(0 if done else 1)
+
+    done = False
+    with RegenerationMockScript(verbose, mock_dirs) as mock_script:
+        with dry_run([make_cmd] + logging_mode_flags + list(make_args), mock_script) as make:
+            args['infile'] = make.stdout
+            done = generate(**args)
     exit(0 if done else 1)
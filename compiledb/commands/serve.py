@@ -0,0 +1,175 @@
+import click
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import threading
+
+from sys import exit, stdout
+
+from compiledb import iter_json_compdb, update_json_compdb
+from compiledb.client import request
+from compiledb.parser import Error
+
+logger = logging.getLogger(__name__)
+
+
+def entry_key(entry):
+    return os.path.join(entry['directory'], entry['file'])
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                req = json.loads(line.decode('utf-8'))
+                reply = self.server.dispatch(req)
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                req, reply = None, {'error': 'Invalid request: {}'.format(e)}
+            self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+            if req and req.get('command') == 'stop':
+                # shutdown() blocks until serve_forever() returns, so it can't be called from a handler
+                threading.Thread(target=self.server.shutdown).start()
+                return
+
+
+class CompdbServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Keeps a compilation database in memory, indexed by entry, merging the
+    entries sent by clients (see compiledb.client) into it. The database is
+    written to outfile once no update was received for persist_delay seconds,
+    and when the server stops, so that clients only pay for their new entries."""
+    daemon_threads = True
+
+    def __init__(self, path, outfile, strict=False, compact=False, persist_delay=2):
+        self.path = path
+        self.outfile = outfile
+        self.strict = strict
+        self.compact = compact
+        self.persist_delay = persist_delay
+        self._lock = threading.Lock()
+        self._persist_lock = threading.Lock()
+        self._timer = None
+        self._dirty = False
+        # Entries keep their order, updated ones in place and the new ones at the end
+        self.entries = {entry_key(e): e for e in iter_json_compdb(outfile) if 'file' in e}
+        remove_stale_socket(path)
+        super(CompdbServer, self).__init__(path, _RequestHandler)
+
+    def update(self, entries, overwrite=False):
+        counts = {'added': 0, 'updated': 0, 'unchanged': 0}
+        with self._lock:
+            if overwrite:
+                self.entries.clear()
+                self._dirty = True
+            for entry in entries:
+                key = entry_key(entry)
+                old = self.entries.get(key)
+                if old is None:
+                    counts['added'] += 1
+                elif old == entry:
+                    counts['unchanged'] += 1
+                    continue
+                else:
+                    counts['updated'] += 1
+                self.entries[key] = entry
+                self._dirty = True
+            if self._dirty:
+                self._schedule_persist()
+        return counts
+
+    def _schedule_persist(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(self.persist_delay, self.persist)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def persist(self):
+        # Persisting is serialized, so that older snapshots never overwrite newer ones
+        with self._persist_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                if not self._dirty:
+                    return
+                self._dirty = False
+                compdb = list(self.entries.values())
+            # Entries whose files don't exist anymore are dropped (unless not strict)
+            update_json_compdb(compdb, self.outfile, overwrite=True, strict=self.strict, compact=self.compact)
+
+    def dispatch(self, req):
+        command = req['command']
+        if command == 'update':
+            return self.update(req['entries'], req.get('overwrite', False))
+        elif command == 'flush':
+            self.persist()
+            return {'entries': len(self.entries)}
+        elif command == 'status':
+            return {'entries': len(self.entries), 'pending': self._dirty}
+        elif command == 'stop':
+            # The database is written before replying, the server is shut down once the reply is sent
+            self.persist()
+            return {'entries': len(self.entries)}
+        return {'error': "Unknown command '{}'".format(command)}
+
+
+def remove_stale_socket(path):
+    """Remove the socket left behind by a previous server, unless it is still running."""
+    if not os.path.exists(path):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        os.remove(path)
+    else:
+        raise Error("A compiledb server is already listening on {}".format(path))
+    finally:
+        sock.close()
+
+
+def _terminate(signum, frame):
+    exit(0)
+
+
+@click.command(name='serve')
+@click.option('-s', '--socket', 'socket_path', type=click.Path(dir_okay=False),
+              help="Unix socket to listen on (Default: the output file path, followed by .sock).")
+@click.option('--persist-delay', type=click.FloatRange(min=0), default=2, show_default=True,
+              help="Seconds without updates after which the database is written.")
+@click.option('--stop', is_flag=True, default=False,
+              help="Stop the server listening on the socket, after it writes the database.")
+@click.pass_context
+def command(ctx, socket_path, persist_delay, stop):
+    """Runs a server keeping the compilation database in memory.
+     Other compiledb runs given --server SOCKET send their entries to it,
+     instead of loading, merging and writing the whole database themselves."""
+    options = ctx.obj
+    if options.outfile.name == stdout.name:
+        raise click.UsageError("The server can't write the compilation database to stdout")
+    socket_path = socket_path or os.path.abspath(options.outfile.name) + '.sock'
+
+    try:
+        if stop:
+            request(socket_path, 'stop')
+            exit(0)
+        server = CompdbServer(socket_path, options.outfile, strict=options.strict, compact=options.compact,
+                              persist_delay=persist_delay)
+    except Error as e:
+        logger.error(e)
+        exit(1)
+
+    signal.signal(signal.SIGTERM, _terminate)
+    logger.info("## Serving compilation database {} on {}".format(options.outfile.name, socket_path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+        server.persist()
+        logger.info("## Done.")
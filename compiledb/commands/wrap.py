@@ -0,0 +1,105 @@
+import click
+import json
+import logging
+import os
+import sys
+
+from sys import exit
+
+from compiledb import update_json_compdb, wrap
+from compiledb.parser import parse_build_log, Error
+from compiledb.utils import cmd_join
+
+logger = logging.getLogger(__name__)
+
+# Suffix of the spool files being collected
+COLLECTING_SUFFIX = '.collecting'
+
+
+def default_spool_dir(outfile):
+    return os.environ.get(wrap.SPOOL_ENV) or os.path.abspath(outfile.name) + '.spool'
+
+
+def wrapper_command(spool_dir):
+    """Command to be prepended to compiler commands so that they are recorded. The wrapper
+    script is run directly, with site-packages disabled, so that it starts quickly."""
+    return cmd_join([sys.executable, '-S', os.path.abspath(wrap.__file__), wrap.SPOOL_OPTION + spool_dir])
+
+
+def claim_spool(spool_dir, keep=False):
+    """Return the spool files, oldest first. Unless keeping them, files are renamed
+    first, so that commands recorded meanwhile go to new files. Renamed files are
+    only removed once collected, and are claimed again by the next collect if
+    collecting them failed."""
+    try:
+        names = [n for n in os.listdir(spool_dir) if n.endswith(('.jsonl', COLLECTING_SUFFIX))]
+    except FileNotFoundError:
+        raise Error("Spool dir '{}' does not exist".format(spool_dir))
+    paths = sorted((os.path.join(spool_dir, n) for n in names), key=os.path.getmtime)
+
+    if keep:
+        return paths
+    claimed = []
+    for path in paths:
+        if not path.endswith(COLLECTING_SUFFIX):
+            os.replace(path, path + COLLECTING_SUFFIX)
+            path += COLLECTING_SUFFIX
+        claimed.append(path)
+    return claimed
+
+
+def read_spool(paths):
+    """Yield the (directory, arguments) records of the spool files."""
+    for path in paths:
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    yield record['directory'], record['arguments']
+                except (ValueError, KeyError, TypeError) as e:
+                    logger.debug("Ignoring invalid record in {}: {}".format(path, e))
+
+
+@click.command(name='wrap')
+@click.option('--spool', 'spool_dir', type=click.Path(file_okay=False),
+              help="Directory the commands are recorded in (Default: $COMPILEDB_SPOOL, or the output "
+              "file path followed by .spool).")
+@click.pass_context
+def wrap_command(ctx, spool_dir):
+    """Prints a compiler wrapper command recording the compiler commands.
+     Prepend it to the compilers used by the build (e.g: make CC="$(compiledb wrap) gcc"),
+     then run compiledb collect to generate the compilation database."""
+    spool_dir = os.path.abspath(spool_dir or default_spool_dir(ctx.obj.outfile))
+    click.echo(wrapper_command(spool_dir))
+
+
+@click.command(name='collect')
+@click.option('--spool', 'spool_dir', type=click.Path(file_okay=False),
+              help="Directory the commands were recorded in (Default: $COMPILEDB_SPOOL, or the output "
+              "file path followed by .spool).")
+@click.option('--keep', is_flag=True, default=False,
+              help="Keep the recorded commands, instead of removing them once collected.")
+@click.pass_context
+def collect_command(ctx, spool_dir, keep):
+    """Generates compilation database file from the commands recorded by compiledb wrap."""
+    options = ctx.obj
+    spool_dir = spool_dir or default_spool_dir(options.outfile)
+
+    try:
+        logger.info("## Collecting commands recorded in {}".format(spool_dir))
+        paths = claim_spool(spool_dir, keep)
+        result = parse_build_log(read_spool(paths), options.build_dir, options.exclude_files,
+                                 command_style=options.command_style,
+                                 add_predefined_macros=options.add_predefined_macros,
+                                 use_full_path=options.use_full_path, macros_file=options.macros_file,
+                                 spooled=True)
+        update_json_compdb(result.compdb, options.outfile, overwrite=options.overwrite, strict=options.strict,
+                           compact=options.compact, delta=options.delta, server=options.server)
+        if not keep:
+            for path in paths:
+                os.remove(path)
+        logger.info("## Done.")
+    except Error as e:
+        logger.error(e)
+        exit(1)
+    exit(0)
@@ -1,20 +1,58 @@
+import hashlib
+import json
 import logging
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 from shutil import which
 from subprocess import PIPE
 
-from compiledb.utils import popen
+from compiledb import cache
+from compiledb.utils import popen, cmd_join, cmd_quote
 
 _logger = logging.getLogger(__name__)
 
+# Flags which may change the set of macros predefined by the compiler (e.g: multilib
+# builds), so that they must also be passed to the probe command.
+_macro_flags_regex = re.compile(
+    r"^(?:-m.+|--target=.+|-std=.+|-ansi|-O.*|-pthread|--sysroot=.+|"
+    r"-f(?:no-)?(?:pic|PIC|pie|PIE|signed-char|unsigned-char|short-wchar|short-enums|exceptions|"
+    r"cxx-exceptions|rtti|fast-math|finite-math-only|openmp.*|sanitize=.+|stack-protector.*|"
+    r"wrapv|trapv|char8_t|coroutines|gnu89-inline|cf-protection.*))$")
+# Same, but for flags taking their value as a separate argument
+_macro_flags_with_value = {"-target", "--sysroot", "-isysroot", "-arch"}
+
+# Maximum number of macro probes run concurrently
+MACROS_PROBE_JOBS = 8
+_probe_executor = None
+
+
+def _get_probe_executor():
+    global _probe_executor
+    if _probe_executor is None:
+        _probe_executor = ThreadPoolExecutor(MACROS_PROBE_JOBS)
+    return _probe_executor
+
+
+# Cache of `which` results, keyed by (name, $PATH)
+_which_cache = {}
+
+
+def _which(name):
+    path = os.environ.get("PATH", os.defpath)
+    key = (name, path)
+    if key not in _which_cache:
+        _which_cache[key] = which(name, path=path)
+    return _which_cache[key]
+
 
 class Compiler:
-    def __init__(self, name="gcc"):
+    def __init__(self, name="gcc", full_path=None):
         # Name of the compiler executable
         self._name = name
 
-        # Full path to the compiler executable
-        self._full_path = self._find_full_path()
+        # Full path to the compiler executable, lazily resolved when not known upfront
+        self._full_path = full_path
 
         # Supported languages by the compiler
         self._languages = {
@@ -22,13 +60,22 @@ class Compiler:
                 "extensions": ["c"]
             },
             "c++": {
-                "extensions": ["cpp", "cc", "cx", "cxx", ".cu"],
+                "extensions": ["cpp", "cc", "cx", "cxx", "cu"],
             },
         }
 
-        # Keep a list of macros for each language since, for example, gcc can be used both for C and C++ sources.
+        # Keep a list of macros for each language since, for example, gcc can be used both for C and C++ sources,
+        # and for each set of target-affecting flags (e.g: -m32). Probes run asynchronously, so futures are stored.
         self._predefined_macros = {
-            # language: ["-DMACRO1", "-DMACRO2=1"]
+            # (language, flags): Future(["-DMACRO1", "-DMACRO2=1"])
+        }
+
+        # Shared (language, flags) keys
+        self._macros_keys = {}
+
+        # Response files holding the predefined macros, keyed as above
+        self._macros_files = {
+            # (language, flags): "/path/to/macros/file.rsp"
         }
 
     def __str__(self):
@@ -36,7 +83,7 @@ class Compiler:
 
     def _find_full_path(self):
         """Get a full path to the compiler executable."""
-        full_path = which(self.name)
+        full_path = _which(self.name)
 
         if full_path is None:
             full_path = self.name
@@ -59,22 +106,49 @@ class Compiler:
 
         _, extension = os.path.splitext(source_file)
 
-        if extension in self._languages["c++"]["extensions"]:
+        if extension[1:] in self._languages["c++"]["extensions"]:
             return "c++"
         else:
             return default
 
-    def _add_predefined_macros(self, language):
-        """Add a list of macros predefined by the compiler for future use."""
-        self._predefined_macros[language] = []
-        # Dump all predefined compiler macros
-        cmd = "echo | " + self.name + " -x " + language + " -dM -E -"
+    @staticmethod
+    def _get_macro_flags(arguments):
+        """Get the subset of flags that may affect the predefined macros."""
+        flags = []
+        args = iter(arguments[1:])
+        for arg in args:
+            if arg in _macro_flags_with_value:
+                flags += [arg, next(args, "")]
+            elif _macro_flags_regex.match(arg):
+                flags.append(arg)
+        return tuple(flags)
+
+    def _cache_key(self, language, flags=()):
+        """Key identifying a macros probe in the persistent cache. It includes
+        the compiler binary size/mtime, so that it changes along with the toolchain."""
+        path = os.path.realpath(self.full_path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return {
+            "compiler": path,
+            "mtime": st.st_mtime_ns,
+            "size": st.st_size,
+            "language": language,
+            "flags": list(flags),
+        }
+
+    def _probe_predefined_macros(self, language, flags=()):
+        """Dump all the macros predefined by the compiler for the given language."""
+        macros = []
+        cmd = "echo | " + cmd_join([self.full_path, "-x", language] + list(flags) + ["-dM", "-E", "-"])
 
         try:
             pipe = popen(cmd, stdout=PIPE)
         except (OSError, ValueError) as e:
             _logger.error(e)
-            return
+            return macros, False
 
         for line in pipe.stdout:
             columns = line.split()
@@ -87,9 +161,40 @@ class Compiler:
             else:
                 def_arg = "-D" + columns[1] + "=" + " ".join(columns[2:])
 
-            self._predefined_macros[language].append(def_arg)
+            macros.append(def_arg)
+
+        return macros, pipe.wait() == 0
 
-        pipe.wait()
+    def _load_predefined_macros(self, language, flags=()):
+        """Get the list of macros predefined by the compiler, either from the cache or probing it."""
+        key = self._cache_key(language, flags)
+        macros = cache.load("macros", key) if key else None
+
+        if macros is None:
+            macros, succeeded = self._probe_predefined_macros(language, flags)
+            if key and succeeded:
+                cache.store("macros", key, macros)
+
+        return macros
+
+    def _write_macros_file(self, language, flags, macros):
+        """Write macros to a response file in the cache dir, named after the
+        probe key, and return its path. Existing files are left untouched."""
+        key = self._cache_key(language, flags) or {"compiler": self.name, "language": language, "flags": list(flags)}
+        digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+        name = "{}-{}-{}.rsp".format(os.path.basename(self.name), language, digest[:16])
+        path = os.path.join(cache.cache_dir("macros-files"), name)
+        content = "".join(cmd_quote(m) + "\n" for m in macros)
+
+        try:
+            with open(path, "r") as f:
+                if f.read() == content:
+                    return path
+        except OSError:
+            pass
+
+        cache.write_atomically(path, content)
+        return path
 
     @property
     def name(self):
@@ -97,26 +202,71 @@ class Compiler:
 
     @property
     def full_path(self):
-        return self._full_path
+        if self._full_path is not None:
+            return self._full_path
+        return self._find_full_path()
+
+    def macros_key(self, arguments, source_file):
+        """Key identifying the macros predefined for a command: its language and
+        its target-affecting flags. Equal keys are shared, so they are cheap to keep."""
+        key = (self._get_language(arguments, source_file), self._get_macro_flags(arguments))
+        return self._macros_keys.setdefault(key, key)
+
+    def macros_future(self, key):
+        """Return a future for the list of macros predefined for key (see macros_key).
+        Distinct probes run concurrently, so callers are not blocked by them."""
+        future = self._predefined_macros.get(key)
+        if future is None:
+            future = _get_probe_executor().submit(self._load_predefined_macros, *key)
+            self._predefined_macros[key] = future
+
+        return future
+
+    def macros_file(self, key):
+        """Return the path of a response file (to be passed as @path) holding the
+        macros predefined for key (see macros_key), or None if there are no such
+        macros. It is written once for each language and set of target-affecting flags."""
+        if key not in self._macros_files:
+            macros = self.macros_future(key).result()
+            self._macros_files[key] = self._write_macros_file(*key, macros) if macros else None
+
+        return self._macros_files[key]
 
     def get_predefined_macros(self, arguments, source_file):
         """Return a list of macros predefined by the compiler."""
-        language = self._get_language(arguments, source_file)
-
-        if language not in self._predefined_macros:
-            self._add_predefined_macros(language)
-
-        return self._predefined_macros[language]
+        return self.macros_future(self.macros_key(arguments, source_file)).result()
 
 
-_compilers = []
+# Registry of known compilers, keyed by name
+_compilers = {}
 
 
 def get_compiler(name):
-    c = next((compiler for compiler in _compilers if name == compiler.name), None)
+    c = _compilers.get(name)
 
     if c is None:
         c = Compiler(name)
-        _compilers.append(c)
+        _compilers[name] = c
 
     return c
+
+
+def register_compiler(name, full_path=None):
+    """Add a compiler to the registry, optionally with its known full path."""
+    c = Compiler(name, full_path)
+    _compilers[name] = c
+    return c
+
+
+def load_toolchain_manifest(stream):
+    """Pre-seed the compilers registry from a JSON toolchain manifest, mapping
+    compiler names to the full path of their executables, e.g:
+    {"arm-linux-gnueabi-gcc": "/opt/toolchains/arm/bin/arm-linux-gnueabi-gcc"}"""
+    manifest = json.load(stream)
+    if not isinstance(manifest, dict):
+        raise ValueError("Toolchain manifest must be a JSON object")
+
+    for name, full_path in manifest.items():
+        register_compiler(name, full_path)
+
+    _logger.info("## Loaded {} compilers from toolchain manifest".format(len(manifest)))
@@ -0,0 +1,104 @@
+#
+#   compiledb: Tool for generating LLVM Compilation Database
+#   files for make-based build systems.
+#
+#   Copyright (c) 2017 Nick Diego Yamane <nick.diego@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Compact in-memory representation of compilation database entries.
+
+Entries of a build usually share most of their flags, so arguments are
+stored as a sequence of de-duplicated tuples of interned strings: the
+arguments preceding the source file, the source file itself and the ones
+following it (e.g: -o file.o), plus any extra ones appended afterwards
+(e.g: predefined macros)."""
+import sys
+from collections.abc import Mapping
+
+
+class ArgumentsTable(object):
+    """Pool of argument tuples shared among entries."""
+
+    def __init__(self):
+        self._tuples = {}
+
+    def share(self, arguments):
+        arguments = tuple(sys.intern(a) for a in arguments)
+        return self._tuples.setdefault(arguments, arguments)
+
+
+class CompileCommand(Mapping):
+    """A compilation database entry. It behaves as a read-only dict with
+       'directory', 'file' and either 'arguments' or 'command' keys, and
+       should be converted with to_dict() before being serialized."""
+    __slots__ = ('directory', 'file', 'command_style', '_parts', '_table')
+
+    def __init__(self, directory, arguments, file, command_style=False, table=None):
+        self.directory = sys.intern(directory)
+        self.file = file
+        self.command_style = command_style
+        self._table = table if table is not None else ArgumentsTable()
+        self._parts = self._split(arguments)
+
+    def _split(self, arguments):
+        share = self._table.share
+        for i in range(len(arguments) - 1, -1, -1):
+            if arguments[i] == self.file:
+                return (share(arguments[:i]), (self.file,), share(arguments[i + 1:]))
+        return (share(arguments),)
+
+    @property
+    def arguments(self):
+        if len(self._parts) == 1:
+            return list(self._parts[0])
+        return [a for part in self._parts for a in part]
+
+    @property
+    def command(self):
+        return ' '.join(self.arguments)
+
+    def extend_arguments(self, arguments):
+        """Append arguments (e.g: predefined macros) to the command."""
+        if arguments:
+            self._parts += (self._table.share(arguments),)
+
+    def keys(self):
+        return ('directory', 'command' if self.command_style else 'arguments', 'file')
+
+    def __getitem__(self, key):
+        if key == 'directory':
+            return self.directory
+        if key == 'file':
+            return self.file
+        if key == ('command' if self.command_style else 'arguments'):
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return 3
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def to_dict(self):
+        return {key: self[key] for key in self.keys()}
+
+
+def to_dict(entry):
+    """Convert an entry to a plain dict, as needed by the JSON encoder."""
+    return entry.to_dict() if isinstance(entry, CompileCommand) else entry
@@ -19,11 +19,18 @@
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 import bashlex
+import os
 import re
 import logging
 
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+
 from compiledb.compiler import get_compiler
-from compiledb.utils import run_cmd
+from compiledb.entry import ArgumentsTable, CompileCommand
+from compiledb.tokenizer import split_commands, UnsupportedSyntax
+from compiledb.utils import cmd_join, run_cmd
 
 # Internal variables used to parse build log entries
 cc_compile_regex = re.compile(r"^.*-?g?cc-?[0-9.]*$|^.*-?clang-?[0-9.]*$")
@@ -31,24 +38,47 @@ cpp_compile_regex = re.compile(r"^.*-?[gc]\+\+-?[0-9.]*$|^.*-?clang\+\+-?[0-9.]*
 file_regex = re.compile(r"^.+\.c$|^.+\.cc$|^.+\.cpp$|^.+\.cxx$|^.+\.cu$|^.+\.s$", re.IGNORECASE)
 compiler_wrappers = {"ccache", "icecc", "sccache"}
 
+# Available build command parsing engines
+PARSERS = ('bashlex', 'fast')
+
+# Number of lines sent at once to each worker process when parsing in parallel
+PARALLEL_CHUNK_SIZE = 512
+
 # Leverage `make --print-directory` option
-make_enter_dir = re.compile(r"^\s*make\[\d+\]: Entering directory [`\'\"](?P<dir>.*)[`\'\"]\s*$")
-make_leave_dir = re.compile(r"^\s*make\[\d+\]: Leaving directory .*$")
+make_enter_dir = re.compile(r"^\s*make(?:\[\d+\])?: Entering directory [`\'\"](?P<dir>.*)[`\'\"]\s*$")
+make_leave_dir = re.compile(r"^\s*make(?:\[\d+\])?: Leaving directory [`\'\"]?(?P<dir>.*?)[`\'\"]?\s*$")
 
 # We want to skip such lines from configure to avoid spurious MAKE expansion errors.
 checking_make = re.compile(r"^checking whether .* sets \$\(\w+\)\.\.\. (yes|no)$")
 
+# Cheap single-pass line classification, run before any shell parsing. A line can
+# only yield a compilation entry if some word looks like a compiler (see regexes
+# above) or if it may be produced by a command substitution.
+line_filter_regex = re.compile(r"(?P<make_dir>^\s*make(?:\[\d+\])?: (?:Entering|Leaving) directory )|"
+                               r"(?P<compiler>(?:cc|clang|\+\+)-?[0-9.]*(?=$|[\s\"';&|()<>`]))|"
+                               r"(?P<subst>\$\(|`)")
+
+# Response-file like references to be inlined, e.g: @"path/to/file"
+inline_file_regex = re.compile(r'@"(.*?)"')
+
 logger = logging.getLogger(__name__)
 
 
 class ParsingResult(object):
     def __init__(self):
         self.skipped = 0
+        self.filtered = 0
         self.count = 0
+        self.subst_hits = 0
+        self.subst_misses = 0
+        self.dir_mismatches = 0
         self.compdb = []
+        # Entries waiting for their predefined macros
+        self.pending_macros = []
 
     def __str__(self):
-        return "Line count: {}, Skipped: {}, Entries: {}".format(self.count, self.skipped, str(self.compdb))
+        return "Line count: {}, Skipped: {}, Filtered: {}, Entries: {}".format(
+            self.count, self.skipped, self.filtered, str(self.compdb))
 
 
 class Error(Exception):
@@ -60,47 +90,32 @@ class Error(Exception):
 
 
 def preprocess_build_log(build_log):
-    new_build_log = []
-    inline_file_pattern = '@"(.*?)"'
-
+    """Lazily expand inline `@"file"` references, yielding one line at a time
+       so that arbitrarily large build logs (e.g. a make pipe) are never fully
+       loaded into memory. Line terminators are kept, they are needed to detect
+       backslash-continued lines."""
     for line in build_log:
-        result = re.search(inline_file_pattern, line)
+        result = inline_file_regex.search(line)
         while result is not None:
             inline_file_path = result.group(1)
             with open(inline_file_path, "r") as file:
                 inlined_text = file.read()
-            line = re.sub(pattern=inline_file_pattern, repl=inlined_text, string=line)
-            result = re.search(inline_file_pattern, line)
-        new_build_log += line.splitlines() or [line]
+            line = inline_file_regex.sub(repl=inlined_text, string=line)
+            result = inline_file_regex.search(line)
+        yield from line.splitlines(keepends=True) or [line]
 
-    return new_build_log
-
-
-def parse_build_log(build_log, proj_dir, exclude_files, command_style=False, add_predefined_macros=False,
-                    use_full_path=False, extra_wrappers=[]):
-    result = ParsingResult()
-
-    def skip_line(cmd, reason):
-        logger.debug("Line {}: {}. Ignoring: '{}'".format(lineno, reason, cmd))
-        result.skipped += 1
-
-    exclude_files_regex = None
-    if len(exclude_files) > 0:
-        try:
-            exclude_files = "|".join(exclude_files)
-            exclude_files_regex = re.compile(exclude_files)
-        except re.error:
-            raise Error('Exclude files regex not valid: {}'.format(exclude_files))
-
-    compiler_wrappers.update(extra_wrappers)
 
+def scan_build_log(build_log, proj_dir, result):
+    """First (cheap) pass over the build log, which joins backslash-continued
+       lines, keeps track of the directories make enters/leaves and filters out
+       lines that can't be compilation commands. Yields (lineno, line, working_dir)
+       tuples for the remaining lines, to be processed by CommandProcessor."""
     dir_stack = [proj_dir]
     working_dir = proj_dir
     lineno = 0
 
     build_log = preprocess_build_log(build_log)
 
-    # Process build log
     for line in build_log:
         lineno += 1
         # Concatenate line if need
@@ -111,82 +126,312 @@ def parse_build_log(build_log, proj_dir, exclude_files, command_style=False, add
             accumulate_line += line
         line = accumulate_line.rstrip()
 
-        # Parse directory that make entering/leaving
-        enter_dir = make_enter_dir.match(line)
-        if (make_enter_dir.match(line)):
-            working_dir = enter_dir.group('dir')
-            dir_stack.append(working_dir)
-            continue
-        if (make_leave_dir.match(line)):
-            dir_stack.pop()
-            working_dir = dir_stack[-1]
+        line_kind = line_filter_regex.search(line)
+        if line_kind is None:
+            # Can't be a compilation command, no need to parse it
+            result.filtered += 1
+            result.skipped += 1
             continue
+
+        # Parse directory that make entering/leaving
+        if line_kind.lastgroup == 'make_dir':
+            enter_dir = make_enter_dir.match(line)
+            if enter_dir:
+                working_dir = enter_dir.group('dir')
+                dir_stack.append(working_dir)
+                continue
+            leave_dir = make_leave_dir.match(line)
+            if leave_dir:
+                leaving = leave_dir.group('dir')
+                if leaving != dir_stack[-1] or len(dir_stack) == 1:
+                    # Make output got interleaved (e.g: parallel make without --output-sync)
+                    # or truncated, so the working dir may be wrong for some lines.
+                    logger.debug("Line {}: Leaving directory '{}', but '{}' was the last one entered".format(
+                        lineno, leaving, dir_stack[-1]))
+                    result.dir_mismatches += 1
+                if leaving in dir_stack[1:]:
+                    # Only leave that directory, the ones entered after it may still be open
+                    del dir_stack[len(dir_stack) - 1 - dir_stack[::-1].index(leaving)]
+                working_dir = dir_stack[-1]
+                continue
         if (checking_make.match(line)):
             continue
 
-        commands = []
+        yield lineno, line, working_dir
+
+
+def _parse_error(err):
+    return 'Failed to parse build command [Details: ({}) {}]'.format(type(err), str(err))
+
+
+def _prepare_line(line, working_dir, parser, substs):
+    try:
+        return CommandProcessor.prepare(line, working_dir, parser, substs), None
+    except Exception as err:
+        return None, _parse_error(err)
+
+
+def _complete_line(prepared):
+    finish, error = prepared
+    if error is not None:
+        return None, error
+    try:
+        return finish(), None
+    except Exception as err:
+        return None, _parse_error(err)
+
+
+def process_line(line, working_dir, parser, substs=None):
+    """Extract the compilation commands from a single build log line.
+       Returns a (commands, error) tuple, error being None on success."""
+    return _complete_line(_prepare_line(line, working_dir, parser, substs))
+
+
+def process_lines(lines, parser, substs, prefetch=0):
+    """Process (lineno, line, working_dir) tuples, yielding them along with
+       their process_line() result. Up to `prefetch` lines are parsed ahead,
+       so that their command substitutions run while waiting for the current
+       line ones."""
+    window = deque()
+    for lineno, line, working_dir in lines:
+        window.append((lineno, line, working_dir, _prepare_line(line, working_dir, parser, substs)))
+        if len(window) > prefetch:
+            lineno, line, working_dir, prepared = window.popleft()
+            yield lineno, line, working_dir, _complete_line(prepared)
+    for lineno, line, working_dir, prepared in window:
+        yield lineno, line, working_dir, _complete_line(prepared)
+
+
+# Per worker process state, used when parsing in parallel
+_worker_substs = None
+
+
+def _init_worker(wrappers, subst_options):
+    global _worker_substs
+    compiler_wrappers.update(wrappers)
+    _worker_substs = SubstitutionRunner(**subst_options)
+
+
+def _process_chunk(chunk, parser):
+    hits, misses = _worker_substs.hits, _worker_substs.misses
+    results = [processed for _, _, _, processed in process_lines(chunk, parser, _worker_substs, len(chunk))]
+    return results, _worker_substs.hits - hits, _worker_substs.misses - misses
+
+
+def _process_lines_parallel(lines, parser, jobs, subst_options, result):
+    """Process lines in chunks using a pool of worker processes. Results are
+       yielded in the original order and at most a few chunks per worker are
+       kept in flight, so memory usage stays bounded."""
+    with ProcessPoolExecutor(jobs, initializer=_init_worker,
+                             initargs=(compiler_wrappers, subst_options)) as executor:
+        pending = deque()
+        chunk = list(islice(lines, PARALLEL_CHUNK_SIZE))
+        while chunk or pending:
+            if chunk:
+                pending.append((chunk, executor.submit(_process_chunk, chunk, parser)))
+                chunk = list(islice(lines, PARALLEL_CHUNK_SIZE))
+            if pending and (not chunk or len(pending) >= 2 * jobs):
+                done, future = pending.popleft()
+                processed_chunk, hits, misses = future.result()
+                result.subst_hits += hits
+                result.subst_misses += misses
+                for (lineno, line, working_dir), processed in zip(done, processed_chunk):
+                    yield lineno, line, working_dir, processed
+
+
+def process_spooled_commands(records):
+    """Process the (directory, arguments) records of the commands run through
+       compiledb wrap, yielding them as process_lines() does. Arguments are
+       exact, so no shell parsing is needed."""
+    for lineno, (directory, arguments) in enumerate(records, 1):
+        processor = CommandProcessor(cmd_join(arguments), directory)
+        processor.process_words(processor.line, arguments)
+        processor.check_last_cmd()
+        yield lineno, processor.line, directory, (processor.commands, None)
+
+
+def parse_build_log(build_log, proj_dir, exclude_files, command_style=False, add_predefined_macros=False,
+                    use_full_path=False, extra_wrappers=[], parser='bashlex', jobs=1,
+                    subst_jobs=1, subst_timeout=None, subst_nocache=[], macros_file=False, result=None,
+                    spooled=False):
+    """Parse the compilation commands in build_log. Entries are added to
+       result.compdb as they are found, so that callers following a growing
+       build log (see FollowedStream) can pass their own result and use the
+       entries parsed so far (after resolve_predefined_macros()) at any time.
+       If spooled is set, build_log holds the (directory, arguments) records
+       of the commands run through compiledb wrap instead."""
+    result = result if result is not None else ParsingResult()
+    add_predefined_macros = add_predefined_macros or macros_file
+
+    def skip_line(cmd, reason):
+        logger.debug("Line {}: {}. Ignoring: '{}'".format(lineno, reason, cmd))
+        result.skipped += 1
+
+    exclude_files_regex = None
+    if len(exclude_files) > 0:
         try:
-            commands = CommandProcessor.process(line, working_dir)
-        except Exception as err:
-            msg = 'Failed to parse build command [Details: ({}) {}]'.format(type(err), str(err))
-            skip_line(line, msg)
-            continue
+            exclude_files = "|".join(exclude_files)
+            exclude_files_regex = re.compile(exclude_files)
+        except re.error:
+            raise Error('Exclude files regex not valid: {}'.format(exclude_files))
 
-        if not commands:
-            result.skipped += 1
+    subst_nocache_regex = None
+    if len(subst_nocache) > 0:
+        try:
+            subst_nocache_regex = re.compile("|".join(subst_nocache))
+        except re.error:
+            raise Error('Substitution no-cache regex not valid: {}'.format("|".join(subst_nocache)))
 
-        for c in commands:
-            filepath = c['filepath']
-            cmd = c['cmd']
-            if filepath is None:
-                skip_line(cmd, 'Empty file name')
-                continue
-            else:
-                result.count += 1
+    if parser not in PARSERS:
+        raise Error('Unknown parser: {}'.format(parser))
+
+    compiler_wrappers.update(extra_wrappers)
+
+    lines = scan_build_log(build_log, proj_dir, result)
+    subst_options = dict(jobs=subst_jobs, timeout=subst_timeout or None, nocache_regex=subst_nocache_regex)
+    substs = SubstitutionRunner(**subst_options)
+    jobs = jobs or os.cpu_count()
+    if spooled:
+        processed_lines = process_spooled_commands(build_log)
+    elif jobs > 1:
+        processed_lines = _process_lines_parallel(lines, parser, jobs, subst_options, result)
+    else:
+        prefetch = 2 * subst_jobs if subst_jobs > 1 else 0
+        processed_lines = process_lines(lines, parser, substs, prefetch)
+
+    # Argument tuples shared among entries
+    arguments_table = ArgumentsTable()
 
-            if filepath and exclude_files_regex and exclude_files_regex.match(filepath):
-                skip_line(cmd, "Excluding file (regex='{}')".format(exclude_files))
+    # Process build log
+    with substs:
+        for lineno, line, working_dir, (commands, error) in processed_lines:
+            if error is not None:
+                skip_line(line, error)
                 continue
 
-            wrappers = c['wrappers']
-            unknown = ["'%s'" % w for w in wrappers if w not in compiler_wrappers]
-            if unknown:
-                unknown = ', '.join(unknown)
-                logger.debug("Add command with unknown wrapper(s) {}".format(unknown))
+            if not commands:
+                result.skipped += 1
 
-            # add entry to database
-            tokens = c['tokens']
-            arguments = [unescape(a) for a in tokens[len(wrappers):]]
+            for c in commands:
+                filepath = c['filepath']
+                cmd = c['cmd']
+                if filepath is None:
+                    skip_line(cmd, 'Empty file name')
+                    continue
+                else:
+                    result.count += 1
 
-            compiler = get_compiler(arguments[0])
+                if filepath and exclude_files_regex and exclude_files_regex.match(filepath):
+                    skip_line(cmd, "Excluding file (regex='{}')".format(exclude_files))
+                    continue
 
-            if add_predefined_macros:
-                predefined_macros = compiler.get_predefined_macros(arguments, filepath)
-                arguments.extend(predefined_macros)
+                wrappers = c['wrappers']
+                unknown = ["'%s'" % w for w in wrappers if w not in compiler_wrappers]
+                if unknown:
+                    unknown = ', '.join(unknown)
+                    logger.debug("Add command with unknown wrapper(s) {}".format(unknown))
 
-            if use_full_path:
-                arguments[0] = compiler.full_path
+                # add entry to database
+                tokens = c['tokens']
+                arguments = tokens[len(wrappers):] if spooled else [unescape(a) for a in tokens[len(wrappers):]]
 
-            command_str = ' '.join(arguments)
+                compiler = get_compiler(arguments[0])
 
-            logger.debug("Adding command {}: {}".format(len(result.compdb), command_str))
+                if use_full_path:
+                    arguments[0] = compiler.full_path
 
-            if command_style:
-                result.compdb.append({
-                    'directory': working_dir,
-                    'command': command_str,
-                    'file': filepath,
-                })
-            else:
-                result.compdb.append({
-                    'directory': working_dir,
-                    'arguments': arguments,
-                    'file': filepath,
-                })
+                logger.debug("Adding command {}: {}".format(len(result.compdb), ' '.join(arguments)))
+
+                entry = CompileCommand(working_dir, arguments, filepath, command_style, arguments_table)
+                result.compdb.append(entry)
+
+                # Predefined macros are probed in background, so parsing doesn't
+                # stall on them. They are added once the whole log is parsed.
+                if add_predefined_macros:
+                    # Only the (shared) probe key is kept, not the arguments
+                    key = compiler.macros_key(arguments, filepath)
+                    compiler.macros_future(key)
+                    result.pending_macros.append((entry, compiler, key))
+
+    resolve_predefined_macros(result, macros_file)
+
+    if result.dir_mismatches:
+        logger.warning("## {} 'Leaving directory' lines didn't match the last directory entered, so some "
+                       "entries may have a wrong directory. Is make output interleaved?".format(result.dir_mismatches))
+
+    result.subst_hits += substs.hits
+    result.subst_misses += substs.misses
+    if result.subst_hits or result.subst_misses:
+        logger.info("## Command substitutions cache hits: {}, misses: {}".format(
+            result.subst_hits, result.subst_misses))
 
     return result
 
 
+def resolve_predefined_macros(result, macros_file=False):
+    """Add the predefined macros to the entries waiting for them, once probed."""
+    for entry, compiler, key in result.pending_macros:
+        if macros_file:
+            path = compiler.macros_file(key)
+            if path is not None:
+                entry.extend_arguments(['@' + path])
+        else:
+            entry.extend_arguments(compiler.macros_future(key).result())
+    del result.pending_macros[:]
+
+
+class SubstitutionRunner(object):
+    """Runs the commands of $(...) and `...` substitutions found in build
+       commands. Their outputs are cached per (command, working dir), except
+       for commands matching nocache_regex (e.g: non-deterministic ones), and
+       distinct commands are run concurrently on a bounded thread pool."""
+    def __init__(self, jobs=1, timeout=None, nocache_regex=None):
+        self.jobs = jobs
+        self.timeout = timeout
+        self.nocache_regex = nocache_regex
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+        self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def run(self, cmd, cwd):
+        return run_cmd(cmd, shell=True, cwd=cwd, timeout=self.timeout).strip()
+
+    def submit(self, cmd, cwd):
+        """Returns a future holding the (stripped) output of cmd."""
+        key = (cmd, cwd)
+        cacheable = self.nocache_regex is None or not self.nocache_regex.search(cmd)
+        if cacheable and key in self.cache:
+            self.hits += 1
+            return self.cache[key]
+
+        self.misses += 1
+        if self.jobs > 1:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(self.jobs)
+            future = self.executor.submit(self.run, cmd, cwd)
+        else:
+            future = Future()
+            try:
+                future.set_result(self.run(cmd, cwd))
+            except Exception as e:
+                future.set_exception(e)
+        if cacheable:
+            self.cache[key] = future
+        return future
+
+
 class SubstCommandVisitor(bashlex.ast.nodevisitor):
     """Uses bashlex to parse and process sh/bash substitution commands.
        May result in a parsing exception for invalid commands."""
@@ -200,28 +445,65 @@ class SubstCommandVisitor(bashlex.ast.nodevisitor):
 
 class CommandProcessor(bashlex.ast.nodevisitor):
     """Uses bashlex to parse and traverse the resulting bash AST
-       looking for and extracting compilation commands."""
+       looking for and extracting compilation commands.
+       With the 'fast' parser, lines are split into simple commands by
+       the lightweight tokenizer instead, falling back to bashlex only
+       for constructs it does not support (e.g: command substitutions)."""
+    @staticmethod
+    def process(line, wd, parser='bashlex', substs=None):
+        return CommandProcessor.prepare(line, wd, parser, substs)()
+
     @staticmethod
-    def process(line, wd):
+    def prepare(line, wd, parser='bashlex', substs=None):
+        """Parse the line and start running its command substitutions, if any.
+           Returns a function which completes the processing (waiting for the
+           substitutions) and returns the compilation commands found."""
+        if parser == 'fast':
+            try:
+                commands = split_commands(line)
+            except UnsupportedSyntax as e:
+                logger.debug("Falling back to bashlex: {}".format(e))
+            else:
+                processor = CommandProcessor(line, wd)
+                for cmd, words in commands:
+                    processor.process_words(cmd, words)
+                processor.check_last_cmd()
+                return lambda: processor.commands
+
         trees = bashlex.parser.parse(line)
         if not trees:
-            return []
+            return list
+        svisitor = SubstCommandVisitor()
         for tree in trees:
-            svisitor = SubstCommandVisitor()
             svisitor.visit(tree)
-            substs = svisitor.substs
-            substs.reverse()
-            preprocessed = list(line)
-            for s in substs:
-                start, end = s.command.pos
-                s_cmd = line[start:end]
-                out = run_cmd(s_cmd, shell=True, cwd=wd)
-                start, end = s.pos
-                preprocessed[start:end] = out.strip()
-            preprocessed = ''.join(preprocessed)
-
-        trees = bashlex.parser.parse(preprocessed)
-        processor = CommandProcessor(preprocessed, wd)
+
+        if not svisitor.substs:
+            return lambda: CommandProcessor.process_trees(line, wd, trees)
+
+        # When command substitutions are found, their output needs to be
+        # spliced into the line, which is then parsed again
+        if substs is None:
+            substs = SubstitutionRunner()
+        outputs = []
+        for s in sorted(svisitor.substs, key=lambda s: s.pos[0]):
+            start, end = s.command.pos
+            outputs.append((s.pos, substs.submit(line[start:end], wd)))
+
+        def finish():
+            parts = []
+            last = 0
+            for (start, end), output in outputs:
+                parts.append(line[last:start])
+                parts.append(output.result())
+                last = end
+            parts.append(line[last:])
+            preprocessed = ''.join(parts)
+            return CommandProcessor.process_trees(preprocessed, wd, bashlex.parser.parse(preprocessed))
+        return finish
+
+    @staticmethod
+    def process_trees(line, wd, trees):
+        processor = CommandProcessor(line, wd)
         for tree in trees:
             processor.do_process(tree)
         return processor.commands
@@ -244,6 +526,12 @@ class CommandProcessor(bashlex.ast.nodevisitor):
         self.check_last_cmd()
         return self.commands
 
+    def process_words(self, cmd, words):
+        self.check_last_cmd()
+        self.cmd = cmd
+        for word in words:
+            self.visitword(None, word)
+
     def visitcommand(self, node, cmd):
         self.check_last_cmd()
         self.cmd = self.line[node.pos[0]:node.pos[1]]
@@ -0,0 +1,229 @@
+#
+#   compiledb: Tool for generating LLVM Compilation Database
+#   files for make-based build systems.
+#
+#   Copyright (c) 2017 Nick Diego Yamane <nick.diego@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Lightweight shell command line tokenizer.
+
+Splits build log lines into simple commands (separated by `;`, `&&`, `||`,
+`|`, etc) and their words, handling quoting, escapes and subshell grouping.
+It mimics the word splitting done by the bashlex based processing, so both
+produce the same results, but it is much cheaper since no bash AST is built.
+Anything not supported (command substitutions, heredocs, loops, ...) raises
+UnsupportedSyntax, so that callers can fall back to bashlex."""
+import re
+
+_token_regex = re.compile(r"""
+    (?P<space>[ \t]+)
+  | (?P<comment>\#[^\n]*)
+  | (?P<unsupported>;;|;&|\(\(|\$[\[({'"]|`|<<|\\\n)
+  | (?P<separator>&&|\|\||\|&|[;|\n]|&(?!>))
+  | (?P<redirect>\d*(?:>&|<&|&>>|&>|>>|>\||<>|[<>]))
+  | (?P<group>[()])
+  | (?P<word>(?:[^\s;&|()<>'"\\`$]|\\[^\n]|'[^']*'|"(?:[^"\\`$]|\\[^\n]|\$(?![\[({]))*"|\$(?![\[({'"]))+)
+""", re.VERBOSE | re.DOTALL)
+
+_quoted_regex = re.compile(r"""\\(.)|'([^']*)'|"((?:[^"\\]|\\.)*)\"""", re.DOTALL)
+_escape_regex = re.compile(r"\\(.)", re.DOTALL)
+_assignment_regex = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*\+?=")
+_fd_regex = re.compile(r"^(?:\d+|-)$")
+
+# Compound command reserved words, mapped to the states they may follow (None
+# when opening a new block) and the resulting state (None when closing it)
+_compound_words = {
+    "if": (None, "if"),
+    "then": (("if", "elif"), "then"),
+    "elif": (("then",), "elif"),
+    "else": (("then",), "else"),
+    "fi": (("then", "else"), None),
+    "while": (None, "while"),
+    "until": (None, "while"),
+    "do": (("while",), "do"),
+    "done": (("do",), None),
+    "{": (None, "{"),
+    "}": (("{",), None),
+    "(": (None, "("),
+    ")": (("(",), None),
+}
+# Constructs that require a real shell parser
+_unsupported_reserved = {"case", "esac", "for", "in", "select", "function", "coproc", "time", "[[", "]]"}
+
+
+class UnsupportedSyntax(Exception):
+    """Raised for shell constructs not handled by the tokenizer."""
+    pass
+
+
+def unquote(word):
+    """Remove quotes and escapes from a (raw) shell word."""
+    if '\\' not in word and '\'' not in word and '"' not in word:
+        return word
+    quoted = []
+
+    def replace(match):
+        escaped, single, double = match.groups()
+        if escaped is not None:
+            return escaped
+        # bashlex drops quotes nested in the other quote type (e.g: '"1.0"' yields 1.0)
+        if single is not None and '"' in single or double is not None and "'" in double:
+            raise UnsupportedSyntax("Unsupported nested quotes in '{}'".format(word))
+        # Backslashes in single quotes are kept, to be decoded by parser.unescape,
+        # while bashlex drops them (e.g: '\$ORIGIN' yields $ORIGIN)
+        if single is not None and '\\' in single:
+            raise UnsupportedSyntax("Unsupported escapes in single quotes in '{}'".format(word))
+        if single is not None:
+            # bashlex keeps single quotes following other quoted strings
+            if quoted:
+                raise UnsupportedSyntax("Unsupported quoting in '{}'".format(word))
+            quoted.append(match)
+            return single
+        quoted.append(match)
+        return _escape_regex.sub(r"\1", double)
+
+    return _quoted_regex.sub(replace, word)
+
+
+def split_commands(line):
+    """Split a command line into a list of (cmd, words) tuples, one for each
+       simple command found in it, where cmd is the command substring and words
+       the list of unquoted words (assignments are not included, redirection
+       targets are). Raises UnsupportedSyntax if the line can't be handled."""
+    commands = []
+    words = []
+    start = end = None
+    at_start = True       # Reserved words are only recognized at command start
+    prefix = True         # Assignments are only recognized before the command name
+    closed = False        # A compound command was just closed
+    redirect = None       # Pending redirection operator, waiting for its target
+    pipeline = False      # A command is required after `&&`, `||`, `|` and `!`
+    piped = False         # Last separator was a pipe, `!` is not allowed
+    blocks = []           # Open compound commands, as [state, units] pairs
+    units = 0             # Number of (simple or compound) commands seen so far
+
+    def compound(word):
+        nonlocal closed, units
+        follows, state = _compound_words[word]
+        if follows is None:
+            blocks.append([state, units])
+            return
+        # Each part of a compound command must have at least one command
+        if not blocks or blocks[-1][0] not in follows or blocks[-1][1] == units:
+            raise UnsupportedSyntax("Unexpected token '{}'".format(word))
+        if state is None:
+            blocks.pop()
+            closed = True
+            units += 1
+        else:
+            blocks[-1] = [state, units]
+
+    pos = 0
+    length = len(line)
+    while pos < length:
+        m = _token_regex.match(line, pos)
+        if m is None:
+            raise UnsupportedSyntax("Unexpected input at position {}".format(pos))
+        kind = m.lastgroup
+        text = m.group(kind)
+        pos = m.end()
+
+        if kind == 'space':
+            continue
+        if kind == 'comment':
+            if m.start() > 0 and line[m.start() - 1] not in ' \t' or '\n' in line[pos:]:
+                raise UnsupportedSyntax("Unsupported multi-line comment")
+            break
+        if kind == 'unsupported':
+            raise UnsupportedSyntax("Unsupported construct '{}'".format(text))
+        if redirect is not None and kind != 'word':
+            raise UnsupportedSyntax("Missing redirection target")
+
+        if kind == 'separator' or text == ')':
+            if start is not None:
+                commands.append((line[start:end], words))
+                units += 1
+            elif not closed or pipeline:
+                raise UnsupportedSyntax("Unexpected token '{}'".format(text))
+            words, start, at_start, prefix, closed = [], None, True, True, False
+            pipeline = text in ('&&', '||', '|', '|&')
+            piped = text in ('|', '|&')
+            if text == ')':
+                compound(text)
+                at_start = False
+            continue
+
+        if closed and kind != 'redirect':
+            raise UnsupportedSyntax("Unexpected token after compound command")
+        pipeline = False
+
+        if kind == 'group':
+            if not at_start or start is not None:
+                raise UnsupportedSyntax("Unexpected token '('")
+            compound(text)
+            continue
+
+        if start is None:
+            start = m.start()
+        end = pos
+
+        if kind == 'redirect':
+            redirect = text
+            at_start = prefix = False
+            continue
+
+        if ("''" in text or '""' in text) and text not in ("''", '""'):
+            raise UnsupportedSyntax("Unsupported empty quoted string")
+        if text in ('{', '}') and (not at_start or redirect is not None):
+            # bashlex handles these in quite peculiar ways
+            raise UnsupportedSyntax("Unsupported construct '{}'".format(text))
+
+        if redirect is not None:
+            # Duplicating/closing file descriptors (e.g: 2>&1) has no target file
+            if redirect.endswith(('>&', '<&')):
+                if text.startswith('-') and text != '-':
+                    raise UnsupportedSyntax("Unsupported redirection")
+                if _fd_regex.match(text):
+                    redirect = None
+                    continue
+            words.append(unquote(text))
+            redirect = None
+            continue
+
+        if at_start:
+            if text in _unsupported_reserved or text.startswith('(('):
+                raise UnsupportedSyntax("Unsupported construct '{}'".format(text))
+            if text in _compound_words or text == '!':
+                if text != '!':
+                    compound(text)
+                elif piped:
+                    raise UnsupportedSyntax("Unexpected token '!'")
+                else:
+                    pipeline = True
+                start = None
+                continue
+            at_start = False
+        if prefix:
+            if _assignment_regex.match(text):
+                continue
+            prefix = False
+
+        words.append(unquote(text))
+
+    if redirect is not None or pipeline or blocks:
+        raise UnsupportedSyntax("Unexpected end of line")
+    if start is not None:
+        commands.append((line[start:end], words))
+    return commands
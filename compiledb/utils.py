@@ -1,4 +1,7 @@
+import os
 import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
 from sys import version_info
 
 if version_info.major >= 3 and version_info.minor >= 6:
@@ -22,3 +25,88 @@ except ImportError:
 
 def cmd_join(cmd):
     return ' '.join(cmd_quote(s) for s in cmd)
+
+
+class FileExistenceCache(object):
+    """Checks whether files exist using a single os.scandir() listing per
+    directory, which is cached. Listings of distinct directories can be
+    prefetched concurrently, which pays off on network file systems."""
+
+    def __init__(self, jobs=16):
+        self.jobs = jobs
+        self._listings = {}
+
+    @staticmethod
+    def _list_dir(dirname):
+        try:
+            with os.scandir(dirname or os.curdir) as it:
+                return frozenset(e.name for e in it)
+        except OSError:
+            return None
+
+    def prefetch(self, paths):
+        """List the directories of paths not listed yet."""
+        dirs = {os.path.dirname(p) for p in paths}
+        dirs = [d for d in dirs if d not in self._listings]
+        if len(dirs) > 1 and self.jobs > 1:
+            with ThreadPoolExecutor(min(self.jobs, len(dirs))) as executor:
+                self._listings.update(zip(dirs, executor.map(self._list_dir, dirs)))
+        else:
+            self._listings.update((d, self._list_dir(d)) for d in dirs)
+
+    def exists(self, path):
+        dirname, name = os.path.split(path)
+        if dirname not in self._listings:
+            self._listings[dirname] = self._list_dir(dirname)
+        listing = self._listings[dirname]
+        if listing is None or not name:
+            # Directory can't be listed (e.g: no read permission)
+            return os.path.exists(path)
+        return name in listing
+
+
+class FollowedStream(object):
+    """Iterates over the lines of a growing file, like `tail -f`. Once the end
+    of the file is reached, it is polled every `interval` seconds, until no
+    new line shows up for `timeout` seconds (forever if None). `on_poll` is
+    called before reading each line, with idle=True when waiting for new ones.
+    Streams that aren't seekable (e.g: pipes) end at their first EOF."""
+
+    def __init__(self, stream, interval=0.5, timeout=None, on_poll=None):
+        self.stream = stream
+        self.interval = interval
+        self.timeout = timeout
+        self.on_poll = on_poll
+        self.name = getattr(stream, 'name', None)
+
+    def _seekable(self):
+        try:
+            return self.stream.seekable()
+        except (AttributeError, ValueError):
+            return False
+
+    def __iter__(self):
+        seekable = self._seekable()
+        partial = ''
+        last_line = time.monotonic()
+        while True:
+            if self.on_poll:
+                self.on_poll(idle=False)
+            line = self.stream.readline()
+            if line:
+                # Lines being written may be read partially
+                partial += line
+                if partial.endswith('\n'):
+                    yield partial
+                    partial = ''
+                    last_line = time.monotonic()
+                continue
+            if not seekable:
+                break
+            if self.on_poll:
+                self.on_poll(idle=True)
+            if self.timeout is not None and time.monotonic() - last_line >= self.timeout:
+                break
+            time.sleep(self.interval)
+        if partial:
+            yield partial
@@ -0,0 +1,85 @@
+#
+#   compiledb: Tool for generating LLVM Compilation Database
+#   files for make-based build systems.
+#
+#   Copyright (c) 2017 Nick Diego Yamane <nick.diego@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Compiler wrapper recording the commands it runs, to be used as, e.g:
+
+    make CC="python3 -S /path/to/compiledb/wrap.py --spool=DIR gcc"
+
+(see `compiledb wrap`). The working directory and exact arguments of each
+command are appended, as a JSON line, to a spool file in DIR (or in
+$COMPILEDB_SPOOL), which `compiledb collect` turns into entries. The real
+compiler is then executed in place of the wrapper.
+
+As this runs for every compiler invocation, it is meant to be run as a
+script and must only import from the standard library (the compiledb
+package imports bashlex, which alone takes longer than most compilations
+of small files)."""
+import json
+import os
+import sys
+
+SPOOL_ENV = 'COMPILEDB_SPOOL'
+SPOOL_OPTION = '--spool='
+
+
+def spool_path(spool_dir):
+    # Commands run by the same make (or shell) process share a spool file. Each
+    # record is appended with a single write, so concurrent writers don't clash.
+    return os.path.join(spool_dir, '{}.jsonl'.format(os.getppid()))
+
+
+def record(spool_dir, arguments):
+    line = json.dumps({'directory': os.getcwd(), 'arguments': arguments}) + '\n'
+    path = spool_path(spool_dir)
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+    except FileNotFoundError:
+        os.makedirs(spool_dir, exist_ok=True)
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+    try:
+        os.write(fd, line.encode('utf-8'))
+    finally:
+        os.close(fd)
+
+
+def main(args=None):
+    args = sys.argv[1:] if args is None else args
+    spool_dir = os.environ.get(SPOOL_ENV)
+    if args and args[0].startswith(SPOOL_OPTION):
+        spool_dir = args.pop(0)[len(SPOOL_OPTION):]
+    if not args:
+        sys.stderr.write('usage: wrap.py [--spool=DIR] COMPILER [ARGS...]\n')
+        return 2
+
+    if spool_dir:
+        try:
+            record(spool_dir, args)
+        except OSError as e:
+            # Never fail the build because of the compilation database
+            sys.stderr.write('compiledb: failed to record command: {}\n'.format(e))
+
+    try:
+        os.execvp(args[0], args)
+    except OSError as e:
+        sys.stderr.write('compiledb: {}: {}\n'.format(args[0], e))
+        return 127
+
+
+if __name__ == '__main__':
+    sys.exit(main())
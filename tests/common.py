@@ -18,6 +18,8 @@
 #   You should have received a copy of the GNU General Public License
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
+import os
+import stat
 from os import path
 
 data_dir = path.abspath(path.join(path.dirname(__file__), 'data'))
@@ -35,3 +37,27 @@ def input_file(relpath):
 def output_file(relpath):
     relpath = '{}'.format(relpath)
     return open(full_path(relpath), 'a+')
+
+
+class FakeCommand(object):
+    """An executable shell script standing for a command (e.g: make or a
+    compiler), which logs the arguments of its invocations to calls_log before
+    running script. Commands in prologue are run before logging them."""
+
+    def __init__(self, path, script, calls_log, prologue=''):
+        self.path = str(path)
+        self.calls_log = str(calls_log)
+        with open(self.path, 'w') as f:
+            f.write('#!/bin/sh\n{}echo "$@" >> {}\n{}'.format(prologue, self.calls_log, script))
+        os.chmod(self.path, os.stat(self.path).st_mode | stat.S_IEXEC)
+
+    def invocations(self):
+        if not path.exists(self.calls_log):
+            return []
+        with open(self.calls_log) as f:
+            return f.read().splitlines()
+
+    def update(self, script):
+        """Append commands to the script."""
+        with open(self.path, 'a') as f:
+            f.write(script)
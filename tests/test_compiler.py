@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+#
+#   compiledb: Tool for generating LLVM Compilation Database
+#   files for make-based build systems.
+#
+#   Copyright (c) 2017 Nick Diego Yamane <nick.diego@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import io
+import os
+import shutil
+
+import pytest
+
+import compiledb.compiler
+from compiledb import cache
+from compiledb.compiler import Compiler, get_compiler, load_toolchain_manifest
+from compiledb.parser import parse_build_log
+from tests.common import FakeCommand
+
+
+@pytest.fixture
+def fake_compiler(tmp_path, monkeypatch):
+    """A fake compiler which logs its invocations and predefines
+    a macro for the requested language."""
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    fake_cc = FakeCommand(bin_dir / 'fake-cc',
+                          'echo "#define FAKE_LANG $2"\n'
+                          'echo "#define FAKE_ARGS $*"\n', tmp_path / 'calls.log')
+    monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ['PATH'])
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    monkeypatch.setattr(compiledb.compiler, '_compilers', type(compiledb.compiler._compilers)())
+    return fake_cc
+
+
+def test_predefined_macros_are_cached_on_disk(fake_compiler):
+    macros = Compiler('fake-cc').get_predefined_macros(['fake-cc', '-c', 'a.c'], 'a.c')
+    assert '-DFAKE_LANG=c' in macros
+    assert len(fake_compiler.invocations()) == 1
+
+    # A new compiler instance (i.e: a new compiledb run) reuses the cache
+    assert Compiler('fake-cc').get_predefined_macros(['fake-cc', '-c', 'a.c'], 'a.c') == macros
+    assert len(fake_compiler.invocations()) == 1
+
+    cache.clear()
+    Compiler('fake-cc').get_predefined_macros(['fake-cc', '-c', 'a.c'], 'a.c')
+    assert len(fake_compiler.invocations()) == 2
+
+
+def test_predefined_macros_cache_invalidation(fake_compiler):
+    Compiler('fake-cc').get_predefined_macros(['fake-cc', '-c', 'a.c'], 'a.c')
+    assert len(fake_compiler.invocations()) == 1
+
+    # Toolchain updated
+    fake_compiler.update('echo "#define FAKE_UPDATED 1"\n')
+    macros = Compiler('fake-cc').get_predefined_macros(['fake-cc', '-c', 'a.c'], 'a.c')
+    assert '-DFAKE_UPDATED=1' in macros
+    assert len(fake_compiler.invocations()) == 2
+
+
+def test_predefined_macros_depend_on_target_flags(fake_compiler):
+    compiler = Compiler('fake-cc')
+    default = compiler.get_predefined_macros(['fake-cc', '-DFOO', '-Iinc', '-c', 'a.c'], 'a.c')
+    multilib = compiler.get_predefined_macros(['fake-cc', '-m32', '-O2', '-c', 'a.c'], 'a.c')
+    cxx = compiler.get_predefined_macros(['fake-cc', '-target', 'arm-linux-gnueabi', '-c', 'a.cpp'], 'a.cpp')
+
+    assert '-DFAKE_ARGS=-x c -dM -E -' in default
+    assert '-DFAKE_ARGS=-x c -m32 -O2 -dM -E -' in multilib
+    assert '-DFAKE_ARGS=-x c++ -target arm-linux-gnueabi -dM -E -' in cxx
+
+    # Flags not affecting predefined macros don't trigger new probes
+    compiler.get_predefined_macros(['fake-cc', '-Wall', '-c', 'b.c'], 'b.c')
+    compiler.get_predefined_macros(['fake-cc', '-m32', '-O2', '-DBAR', '-c', 'b.c'], 'b.c')
+    assert len(fake_compiler.invocations()) == 3
+
+    # Commands with the same language and target flags share their key
+    key = compiler.macros_key(['fake-cc', '-m32', '-O2', '-c', 'a.c'], 'a.c')
+    assert compiler.macros_key(['fake-cc', '-m32', '-O2', '-DBAR', '-c', 'b.c'], 'b.c') is key
+
+
+@pytest.mark.parametrize('command_style', [False, True])
+def test_parse_build_log_with_predefined_macros(fake_compiler, command_style):
+    build_log = ['fake-cc -c a.c\n', 'fake-cc -m64 -c b.c\n']
+    result = parse_build_log(build_log, proj_dir=os.getcwd(), exclude_files=[],
+                             command_style=command_style, add_predefined_macros=True)
+
+    assert result.count == 2
+    if command_style:
+        commands = [e['command'] for e in result.compdb]
+    else:
+        commands = [' '.join(e['arguments']) for e in result.compdb]
+    assert commands[0].startswith('fake-cc -c a.c -DFAKE_LANG=c -DFAKE_ARGS=-x c -dM -E -')
+    assert commands[1].startswith('fake-cc -m64 -c b.c -DFAKE_LANG=c -DFAKE_ARGS=-x c -m64 -dM -E -')
+
+
+def test_parse_build_log_with_macros_file(fake_compiler):
+    build_log = ['fake-cc -c a.c\n', 'fake-cc -c b.c\n', 'fake-cc -m64 -c c.c\n']
+    result = parse_build_log(build_log, proj_dir=os.getcwd(), exclude_files=[], macros_file=True)
+
+    assert result.count == 3
+    macros_files = [e['arguments'][-1] for e in result.compdb]
+    assert all(f.startswith('@' + cache.cache_dir('macros-files')) for f in macros_files)
+    assert [len(e['arguments']) for e in result.compdb] == [4, 4, 5]
+
+    # Written once for each set of target-affecting flags
+    assert macros_files[0] == macros_files[1]
+    assert macros_files[0] != macros_files[2]
+    with open(macros_files[2][1:]) as f:
+        assert f.read().splitlines() == ['-DFAKE_LANG=c', "'-DFAKE_ARGS=-x c -m64 -dM -E -'"]
+
+    # Still referenced by the database, so clearing the cache keeps them
+    cache.clear()
+    assert all(os.path.isfile(f[1:]) for f in macros_files)
+
+
+def test_compiler_registry_resolves_paths_lazily(fake_compiler, monkeypatch):
+    calls = []
+
+    def fake_which(name, path=None):
+        calls.append((name, path))
+        return '/fake/bin/' + name
+
+    monkeypatch.setattr(compiledb.compiler, 'which', fake_which)
+    monkeypatch.setattr(compiledb.compiler, '_which_cache', {})
+
+    compiler = get_compiler('fake-cc')
+    assert get_compiler('fake-cc') is compiler
+    assert calls == []
+
+    assert compiler.full_path == '/fake/bin/fake-cc'
+    assert get_compiler('fake-cc').full_path == '/fake/bin/fake-cc'
+    assert len(calls) == 1
+
+    # Lookups are cached per $PATH
+    monkeypatch.setenv('PATH', '/other/bin')
+    assert compiler.full_path == '/fake/bin/fake-cc'
+    assert calls[-1] == ('fake-cc', '/other/bin')
+    assert len(calls) == 2
+
+
+def test_toolchain_manifest(fake_compiler):
+    manifest = io.StringIO('{"arm-none-eabi-gcc": "/opt/arm/bin/arm-none-eabi-gcc"}')
+    load_toolchain_manifest(manifest)
+
+    assert get_compiler('arm-none-eabi-gcc').full_path == '/opt/arm/bin/arm-none-eabi-gcc'
+    with pytest.raises(ValueError):
+        load_toolchain_manifest(io.StringIO('["gcc"]'))
+
+
+def test_toolchain_manifest_predefined_macros(fake_compiler, tmp_path):
+    # A compiler only known through the manifest, not in $PATH
+    toolchain = tmp_path / 'toolchain'
+    toolchain.mkdir()
+    shutil.copy(shutil.which('fake-cc'), str(toolchain / 'xgcc'))
+    load_toolchain_manifest(io.StringIO('{{"xgcc": "{}"}}'.format(toolchain / 'xgcc')))
+
+    macros = get_compiler('xgcc').get_predefined_macros(['xgcc', '-c', 'a.c'], 'a.c')
+    assert '-DFAKE_LANG=c' in macros
+    assert len(fake_compiler.invocations()) == 1
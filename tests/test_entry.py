@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+#
+#   compiledb: Tool for generating LLVM Compilation Database
+#   files for make-based build systems.
+#
+#   Copyright (c) 2017 Nick Diego Yamane <nick.diego@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import json
+import tracemalloc
+
+import pytest
+
+from compiledb.entry import ArgumentsTable, CompileCommand, to_dict
+
+
+def test_compile_command_mapping():
+    entry = CompileCommand('/src', ['gcc', '-O2', '-c', 'a.c', '-o', 'a.o'], 'a.c')
+    expected = {'directory': '/src', 'arguments': ['gcc', '-O2', '-c', 'a.c', '-o', 'a.o'], 'file': 'a.c'}
+
+    assert entry == expected
+    assert dict(entry) == expected
+    assert json.loads(json.dumps(to_dict(entry))) == expected
+    with pytest.raises(KeyError):
+        entry['command']
+
+    entry.extend_arguments(['-DFOO'])
+    assert entry['arguments'][-1] == '-DFOO'
+
+    entry = CompileCommand('/src', ['gcc', '-c', 'a.c'], 'a.c', command_style=True)
+    assert entry == {'directory': '/src', 'command': 'gcc -c a.c', 'file': 'a.c'}
+
+
+def test_compile_commands_share_arguments():
+    table = ArgumentsTable()
+    a = CompileCommand('/src', ['gcc', '-O2', '-c', 'a.c', '-o', 'a.o'], 'a.c', table=table)
+    b = CompileCommand('/src', ['gcc', '-O2', '-c', 'b.c', '-o', 'b.o'], 'b.c', table=table)
+    assert a._parts[0] is b._parts[0]
+    assert a.directory is b.directory
+
+
+def test_compile_commands_memory_usage():
+    """Measure memory used by entries with mostly shared flags."""
+    def build(count, make_entry):
+        # Strings are created for each entry, as they are when parsing a build log
+        entries = []
+        for i in range(count):
+            source = 'src/file{}.c'.format(i)
+            arguments = ['gcc'] + ['-I/src/include/dir{}'.format(j) for j in range(50)]
+            arguments += ['-DCONFIG_{}=1'.format(j) for j in range(50)] + ['-c', source, '-o', 'file{}.o'.format(i)]
+            entries.append(make_entry('/{}'.format('src'), arguments, source))
+        return entries
+
+    def measure(make_entry):
+        tracemalloc.start()
+        try:
+            entries = build(1000, make_entry)
+            size, _ = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        assert len(entries) == 1000
+        return size
+
+    table = ArgumentsTable()
+    dicts = measure(lambda d, a, f: {'directory': d, 'arguments': a, 'file': f})
+    compact = measure(lambda d, a, f: CompileCommand(d, a, f, table=table))
+    assert compact * 5 < dicts
@@ -18,13 +18,18 @@
 #   You should have received a copy of the GNU General Public License
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
+import io
+import multiprocessing
 import os
 import shutil
 import json
 import pytest
 import sys
+import threading
+import time
 from os.path import basename
-from compiledb import load_json_compdb, generate
+import compiledb
+from compiledb import iter_json_compdb, load_json_compdb, merge_compdb, write_json_compdb, generate, MergeStats
 from tests.common import input_file, output_file, data_dir, full_path
 
 
@@ -132,6 +137,187 @@ def test_generate_output_stdout(capsys, caplog, overwrite):
     assert_compdb_equals(compdb, multiple_commands_oneline_compdb)
 
 
+def test_write_compdb_streams_entries():
+    def entries():
+        for entry in multiple_commands_oneline_compdb:
+            yield entry
+
+    outstream = io.StringIO()
+    write_json_compdb(entries(), outstream)
+    assert outstream.getvalue() == json.dumps(multiple_commands_oneline_compdb, indent=1) + os.linesep
+
+    outstream = io.StringIO()
+    write_json_compdb([], outstream)
+    assert json.loads(outstream.getvalue()) == []
+
+
+@pytest.mark.parametrize('backend', ['default', 'stdlib'])
+def test_write_compdb_compact(monkeypatch, backend):
+    if backend == 'stdlib':
+        monkeypatch.setattr(compiledb, '_dumps_compact', json.JSONEncoder(separators=(',', ':')).encode)
+
+    outstream = io.StringIO()
+    write_json_compdb(multiple_commands_oneline_compdb, outstream, pretty_output=False)
+    lines = outstream.getvalue().splitlines()
+    assert len(lines) == len(multiple_commands_oneline_compdb) + 2
+    assert ' ' not in lines[1]
+    assert json.loads(outstream.getvalue()) == multiple_commands_oneline_compdb
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 1 << 16])
+def test_iter_compdb_incrementally(chunk_size):
+    compdb = multiple_commands_oneline_compdb + [{'directory': '/', 'file': 'x.c', 'command': 'cc "[]{},\\" x.c'}]
+    for pretty_output in (True, False):
+        stream = io.StringIO()
+        write_json_compdb(compdb, stream, pretty_output=pretty_output)
+        assert list(iter_json_compdb(stream, chunk_size)) == compdb
+
+    # Entries preceding an error are still read
+    stream = io.StringIO(json.dumps(compdb)[:-10])
+    assert list(iter_json_compdb(stream, chunk_size)) == compdb[:2]
+    assert list(iter_json_compdb(io.StringIO('[]'), chunk_size)) == []
+    assert list(iter_json_compdb(io.StringIO('{}'), chunk_size)) == []
+
+
+def test_merge_compdb_keeps_order():
+    def entry(name, flag):
+        return {'directory': '/src', 'file': name, 'arguments': ['cc', flag, '-c', name]}
+
+    old = [entry('a.c', '-O0'), entry('b.c', '-O0'), entry('c.c', '-O0'), entry('b.c', '-O1')]
+    new = [entry('d.c', '-O2'), entry('b.c', '-O2')]
+    stats = MergeStats()
+    merged = list(merge_compdb(iter(old), new, check_files=False, stats=stats))
+    assert merged == [old[0], new[1], old[2], new[0]]
+    assert (stats.added, stats.removed, stats.updated, stats.unchanged) == (1, 1, 1, 2)
+
+
+def test_generate_updates_with_streaming_merge(tmp_path):
+    path = str(tmp_path / 'result.json')
+    shutil.copy(full_path('compile_commands2.json'), path)
+    with open(path, 'a+') as outfile:
+        assert_generate_is_true(outfile, overwrite=False)
+        assert_generate_is_true(outfile, overwrite=False)
+
+    with open(path) as instream:
+        assert [e['file'] for e in json.load(instream)] == ['bar.cpp', './path/src/hein.cpp', 'main.c']
+
+
+@pytest.mark.parametrize('overwrite', [False, True])
+def test_generate_skips_unchanged_output(tmp_path, caplog, overwrite):
+    path = str(tmp_path / 'result.json')
+    shutil.copy(full_path('compile_commands2.json'), path)
+    with open(path, 'a+') as outfile:
+        assert_generate_is_true(outfile, overwrite=overwrite)
+    os.utime(path, (0, 0))
+
+    caplog.clear()
+    with open(path, 'a+') as outfile:
+        assert_generate_is_true(outfile, overwrite=overwrite)
+    assert os.stat(path).st_mtime == 0
+    assert 'Compilation database result.json is up to date' in caplog.text
+    if not overwrite:
+        assert 'Added: 0, Removed: 0, Updated: 0, Unchanged: 3' in caplog.text
+
+
+def test_generate_through_symlink(tmp_path):
+    (tmp_path / 'build').mkdir()
+    target = tmp_path / 'build' / 'compile_commands.json'
+    target.write_text('[]')
+    link = tmp_path / 'compile_commands.json'
+    link.symlink_to(target)
+
+    with open(str(link), 'a+') as outfile:
+        assert_generate_is_true(outfile, overwrite=False)
+
+    # The link target is written, and the link is kept
+    assert link.is_symlink()
+    with open(str(target)) as instream:
+        assert_compdb_equals(json.load(instream), multiple_commands_oneline_compdb)
+    assert sorted(os.listdir(str(tmp_path / 'build'))) == ['compile_commands.json', 'compile_commands.json.lock']
+
+
+@pytest.mark.parametrize('overwrite', [False, True])
+def test_generate_delta(tmp_path, overwrite):
+    path = str(tmp_path / 'compile_commands.json')
+    delta = str(tmp_path / 'delta.json')
+    cwd = os.getcwd()
+
+    def run(build_log):
+        with open(path, 'a+') as outfile:
+            assert generate(infile=build_log, outfile=outfile, build_dir=cwd, exclude_files=[],
+                            overwrite=overwrite, delta=delta)
+        with open(delta) as f:
+            return json.load(f)
+
+    run(['gcc -c a.c\n', 'gcc -c b.c\n'])
+    changes = run(['gcc -O2 -c b.c\n', 'gcc -c c.c\n'])
+    assert changes['added'] == [{'directory': cwd, 'file': 'c.c'}]
+    assert changes['modified'] == [{'directory': cwd, 'file': 'b.c'}]
+    assert changes['removed'] == ([{'directory': cwd, 'file': 'a.c'}] if overwrite else [])
+
+    with open(path) as f:
+        files = [e['file'] for e in json.load(f)]
+    assert files == (['b.c', 'c.c'] if overwrite else ['a.c', 'b.c', 'c.c'])
+
+
+def test_generate_follow(tmp_path):
+    path = str(tmp_path / 'compile_commands.json')
+    build_log = str(tmp_path / 'build.log')
+    sub = str(tmp_path / 'sub')
+    cwd = os.getcwd()
+    seen = []
+
+    def read_compdb():
+        with open(path) as f:
+            return [(e['directory'], e['file']) for e in json.load(f)]
+
+    def build():
+        with open(build_log, 'a') as log:
+            log.write("make: Entering directory '{}'\ngcc -c a.c\n".format(sub))
+            log.flush()
+            # The entries parsed so far are written while the build is running
+            deadline = time.monotonic() + 10
+            while time.monotonic() < deadline and not seen:
+                if os.path.getsize(path):
+                    seen.extend(read_compdb())
+                time.sleep(0.05)
+            log.write("gcc -c b.c\nmake: Leaving directory '{}'\ngcc -c c.c\n".format(sub))
+
+    open(build_log, 'w').close()
+    builder = threading.Thread(target=build)
+    builder.start()
+    with open(build_log) as infile, open(path, 'a+') as outfile:
+        assert generate(infile=infile, outfile=outfile, build_dir=cwd, exclude_files=[], overwrite=True,
+                        follow=True, flush_interval=0, follow_timeout=1)
+    builder.join()
+
+    assert seen == [(sub, 'a.c')]
+    assert read_compdb() == [(sub, 'a.c'), (sub, 'b.c'), (cwd, 'c.c')]
+
+
+def generate_shard(args):
+    shard, path = args
+    build_log = ['gcc -c shard{}_{}.c\n'.format(shard, i) for i in range(50)]
+    with open(path, 'a+') as outfile:
+        return generate(infile=build_log, outfile=outfile, build_dir=os.getcwd(), exclude_files=[])
+
+
+def test_generate_concurrent_shards(tmp_path):
+    path = str(tmp_path / 'compile_commands.json')
+    with multiprocessing.Pool(8) as pool:
+        assert all(pool.map(generate_shard, [(shard, path) for shard in range(16)]))
+
+    with open(path) as instream:
+        compdb = json.load(instream)
+    assert len(compdb) == 16 * 50
+    assert sorted(os.listdir(str(tmp_path))) == ['compile_commands.json', 'compile_commands.json.lock']
+
+    # Permissions are not those of the temporary file
+    umask = os.umask(0)
+    os.umask(umask)
+    assert os.stat(path).st_mode & 0o777 == 0o666 & ~umask
+
+
 def assert_generate_is_true(outstream, overwrite):
     with input_file('multiple_commands_oneline.txt') as instream:
         assert generate(
@@ -150,8 +336,9 @@ def assert_compdb_file_equals(outfile_path, expected_compdb):
             compdb = json.load(instream)
             assert_compdb_equals(compdb, expected_compdb)
     finally:
-        if os.path.exists(outfile_path):
-            os.remove(outfile_path)
+        for path in (outfile_path, outfile_path + '.lock'):
+            if os.path.exists(path):
+                os.remove(path)
 
 
 def assert_compdb_equals(compdb, expected_compdb):
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+#
+#   compiledb: Tool for generating LLVM Compilation Database
+#   files for make-based build systems.
+#
+#   Copyright (c) 2017 Nick Diego Yamane <nick.diego@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import json
+import logging
+import shutil
+
+import pytest
+from click.testing import CliRunner
+
+from compiledb.cli import cli
+from tests.common import FakeCommand
+
+
+@pytest.fixture
+def fake_make(tmp_path):
+    """A fake make, which logs its invocations and prints a build log."""
+    (tmp_path / 'src').mkdir()
+    script = ('cd {src}\n'
+              'while [ $# -gt 0 ]; do test "$1" = -C && cd "$2"; shift; done\n'
+              'test -f slow && sleep 0.5\n'
+              'test -f big && cat big\n'
+              'echo "make: Entering directory \'$PWD\'"\n'
+              'echo "gcc -c main.c -o main.o"\n'
+              'echo "make: Leaving directory \'$PWD\'"\n'
+              'exit $FAKE_MAKE_STATUS\n'.format(src=tmp_path / 'src'))
+    # --version calls are not logged
+    prologue = 'test "$1" = --version && echo "GNU Make $FAKE_MAKE_VERSION" && exit 0\n'
+
+    class FakeMake(FakeCommand):
+        def __init__(self):
+            super(FakeMake, self).__init__(tmp_path / 'fake-make', script, tmp_path / 'calls.log', prologue)
+            self.src = str(tmp_path / 'src')
+            self.output = str(tmp_path / 'compile_commands.json')
+
+        def run(self, *args, status=0, options=(), version='4.3'):
+            args = ['-S', '-o', self.output] + list(options) + ['make', '-c', self.path] + list(args)
+            return CliRunner().invoke(cli, args, env={'FAKE_MAKE_STATUS': str(status), 'FAKE_MAKE_VERSION': version})
+
+        def compdb(self):
+            with open(self.output) as f:
+                return json.load(f)
+
+    return FakeMake()
+
+
+def test_make_builds_then_dry_runs(fake_make):
+    result = fake_make.run('all')
+    assert result.exit_code == 0
+    assert fake_make.invocations() == ['all', '-Bnkw all']
+    assert fake_make.compdb() == [{'directory': fake_make.src, 'file': 'main.c',
+                                   'arguments': ['gcc', '-c', 'main.c', '-o', 'main.o']}]
+
+
+def test_make_single_pass(fake_make):
+    result = fake_make.run('--single-pass', 'all')
+    assert result.exit_code == 0
+    assert fake_make.invocations() == ['-w all']
+    assert 'gcc -c main.c -o main.o' in result.output
+    assert fake_make.compdb() == [{'directory': fake_make.src, 'file': 'main.c',
+                                   'arguments': ['gcc', '-c', 'main.c', '-o', 'main.o']}]
+
+
+def test_make_single_pass_failed_build(fake_make):
+    result = fake_make.run('--single-pass', 'all', status=2)
+    assert result.exit_code == 1
+    assert len(fake_make.compdb()) == 1
+
+
+def test_make_dirs_in_parallel(fake_make, tmp_path):
+    dirs = [tmp_path / 'mod{}'.format(i) for i in range(3)]
+    for d in dirs:
+        d.mkdir()
+    # The dry run for the first directory finishes last
+    (dirs[0] / 'slow').write_text('')
+
+    args = [arg for d in dirs for arg in ('--dir', str(d))]
+    result = fake_make.run(*args, '--parallel', '3', 'all', options=['-n'])
+    assert result.exit_code == 0
+    assert sorted(fake_make.invocations()) == sorted('-Bnkw -C {} all'.format(d) for d in dirs)
+    assert [e['directory'] for e in fake_make.compdb()] == [str(d) for d in dirs]
+
+
+def test_make_dry_run_drained_on_error(fake_make, tmp_path):
+    # More output than fits in the pipe, which make would block on if left unread
+    (tmp_path / 'src' / 'big').write_text('echo building\n' * 20000)
+    result = fake_make.run('all', options=['-n', '-e', '('])
+    assert result.exit_code == 1
+    assert fake_make.invocations() == ['-Bnkw all']
+
+
+@pytest.mark.parametrize('version', ['4.3', '3.81'])
+def test_make_parallel_dry_run(fake_make, version):
+    result = fake_make.run('--dry-run-jobs', '4', 'all', options=['-n'], version=version)
+    assert result.exit_code == 0
+    if version == '4.3':
+        assert fake_make.invocations() == ['-Bnkw -j4 --output-sync=recurse all']
+    else:
+        assert fake_make.invocations() == ['-Bnkw all']
+    assert len(fake_make.compdb()) == 1
+
+
+@pytest.fixture
+def make_tree(tmp_path, monkeypatch):
+    """A small recursive make tree, built through a wrapper logging make invocations."""
+    src = tmp_path / 'src'
+    (src / 'sub').mkdir(parents=True)
+    (src / 'Makefile').write_text('include flags.mk\n'
+                                  'all:\n\t$(MAKE) -C sub\n\tgcc $(FLAGS) -c a.c\n')
+    (src / 'flags.mk').write_text('FLAGS = -O1\n')
+    (src / 'sub' / 'Makefile').write_text('all:\n\tgcc -c b.c\n')
+
+    wrapper = FakeCommand(tmp_path / 'make-wrapper', 'exec make "$@"\n', tmp_path / 'calls.log')
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    monkeypatch.chdir(str(src))
+
+    def run(*args):
+        output = str(tmp_path / 'compile_commands.json')
+        result = CliRunner().invoke(cli, ['-n', '-f', '-S', '-o', output, 'make', '-c', wrapper.path] + list(args))
+        assert result.exit_code == 0
+        with open(output) as f:
+            entries = [(e['directory'], ' '.join(e['arguments'])) for e in json.load(f)]
+        return entries, len(wrapper.invocations())
+
+    run.src = src
+    return run
+
+
+@pytest.mark.skipif(shutil.which('make') is None, reason='GNU make not available')
+def test_make_dry_run_cache(make_tree):
+    src = make_tree.src
+    expected = [(str(src / 'sub'), 'gcc -c b.c'), (str(src), 'gcc -O1 -c a.c')]
+    assert make_tree('--cache', 'all') == (expected, 1)
+
+    # Nothing changed, make is not run again
+    assert make_tree('--cache', 'all') == (expected, 1)
+    assert make_tree('--refresh-cache', 'all') == (expected, 2)
+
+    # An included makefile changed
+    (src / 'flags.mk').write_text('FLAGS = -O2\n')
+    expected[1] = (str(src), 'gcc -O2 -c a.c')
+    assert make_tree('--cache', 'all') == (expected, 3)
+    assert make_tree('--cache', 'all') == (expected, 3)
+
+    # Makefile of a sub-make changed
+    (src / 'sub' / 'Makefile').write_text('all:\n\tgcc -c c.c\n')
+    expected[0] = (str(src / 'sub'), 'gcc -c c.c')
+    assert make_tree('--cache', 'all') == (expected, 4)
+
+
+@pytest.mark.skipif(shutil.which('make') is None, reason='GNU make not available')
+def test_make_failed_dry_run_not_cached(make_tree):
+    src = make_tree.src
+    # The sub-make fails on the missing prerequisite, stopping the dry run
+    (src / 'sub' / 'Makefile').write_text('all: missing.h\n\tgcc -c b.c\n')
+    assert make_tree('--cache', 'all') == ([], 1)
+    assert make_tree('--cache', 'all') == ([], 2)
+
+    (src / 'sub' / 'missing.h').write_text('')
+    expected = [(str(src / 'sub'), 'gcc -c b.c'), (str(src), 'gcc -O1 -c a.c')]
+    assert make_tree('--cache', 'all') == (expected, 3)
+    assert make_tree('--cache', 'all') == (expected, 3)
+
+
+@pytest.mark.skipif(shutil.which('make') is None, reason='GNU make not available')
+def test_make_skips_regeneration_commands(tmp_path, monkeypatch, caplog):
+    # Commands remaking the makefile, and '+' ones, are run by make even in dry runs
+    (tmp_path / 'CMakeCache.txt').write_text('')
+    (tmp_path / 'Makefile').write_text(
+        'all:\n\t+cmake -S. -B. --check-build-system CMakeFiles/Makefile.cmake 0\n\tgcc -c a.c\n'
+        'Makefile: CMakeCache.txt\n\tcmake -S. -B. --check-build-system CMakeFiles/Makefile.cmake 1\n')
+    monkeypatch.chdir(str(tmp_path))
+    output = str(tmp_path / 'compile_commands.json')
+
+    with caplog.at_level(logging.INFO):
+        result = CliRunner().invoke(cli, ['-n', '-f', '-S', '-o', output, 'make', 'all'])
+    assert result.exit_code == 0
+    assert 'Skipped 2 build system regeneration commands (cmake: 2)' in caplog.text
+    with open(output) as f:
+        assert [e['arguments'] for e in json.load(f)] == [['gcc', '-c', 'a.c']]
@@ -20,7 +20,11 @@
 #
 from os import getcwd
 
-from compiledb.parser import parse_build_log
+import bashlex
+import compiledb.parser
+import pytest
+
+from compiledb.parser import parse_build_log, preprocess_build_log, CommandProcessor, PARSERS
 from tests.common import input_file
 
 
@@ -265,3 +269,212 @@ def test_parse_file_extensions():
         'file': 'main.cu',
         'arguments': ['nvcc', '-c', 'main.cu', '-o', 'main.o']
     }]
+
+
+def test_continuation_lines_from_stream():
+    pwd = getcwd()
+
+    def build_log():
+        yield 'gcc -c \\\n'
+        yield '    -o hello.o \\\n'
+        yield '    hello.c\n'
+        yield 'echo done\n'
+
+    result = parse_build_log(
+        build_log(),
+        proj_dir=pwd,
+        exclude_files=[])
+
+    assert result.count == 1
+    assert result.skipped == 1
+    assert result.compdb == [{
+        'directory': pwd,
+        'file': 'hello.c',
+        'arguments': ['gcc', '-c', '-o', 'hello.o', 'hello.c']
+    }]
+
+
+def test_build_log_is_consumed_lazily():
+    consumed = []
+
+    def build_log():
+        for i in range(3):
+            consumed.append(i)
+            yield 'gcc -c file{}.c\n'.format(i)
+
+    lines = preprocess_build_log(build_log())
+    assert next(lines) == 'gcc -c file0.c\n'
+    assert consumed == [0]
+
+
+def test_make_directory_blocks_are_verified():
+    pwd = getcwd()
+    build_log = [
+        "make: Entering directory '/tmp/top'\n",
+        "make[1]: Entering directory '/tmp/top/a'\n",
+        'gcc -c a.c\n',
+        "make[1]: Leaving directory '/tmp/top/a'\n",
+        # Interleaved sub-makes
+        "make[1]: Entering directory '/tmp/top/b'\n",
+        "make[1]: Entering directory '/tmp/top/c'\n",
+        "make[1]: Leaving directory '/tmp/top/b'\n",
+        # Still in c, which is left last
+        'gcc -c c.c\n',
+        "make[1]: Leaving directory '/tmp/top/c'\n",
+        'gcc -c top.c\n',
+        "make: Leaving directory '/tmp/top'\n",
+        'gcc -c main.c\n',
+    ]
+    result = parse_build_log(build_log, proj_dir=pwd, exclude_files=[])
+
+    assert [(e['directory'], e['file']) for e in result.compdb] == [
+        ('/tmp/top/a', 'a.c'), ('/tmp/top/c', 'c.c'), ('/tmp/top', 'top.c'), (pwd, 'main.c')]
+    assert result.dir_mismatches == 1
+
+
+def test_non_compile_lines_are_filtered():
+    pwd = getcwd()
+    build_log = [
+        'echo "  CC      main.o"\n',
+        'ar rcs libfoo.a foo.o bar.o\n',
+        'rm -f main.o\n',
+        'mkdir -p out/obj\n',
+        'make[1]: Entering directory \'/tmp/sub\'\n',
+        'gcc -c main.c\n',
+        'make[1]: Leaving directory \'/tmp/sub\'\n',
+        'echo $(echo done)\n',
+    ]
+    result = parse_build_log(
+        build_log,
+        proj_dir=pwd,
+        exclude_files=[])
+
+    assert result.count == 1
+    assert result.filtered == 4
+    assert result.skipped == 5
+    assert result.compdb == [{
+        'directory': '/tmp/sub',
+        'file': 'main.c',
+        'arguments': ['gcc', '-c', 'main.c']
+    }]
+
+
+@pytest.mark.parametrize('log_file', ['autotools_simple.txt', 'multiple_commands_oneline.txt'])
+def test_parsers_generate_same_compdb(log_file):
+    pwd = getcwd()
+    results = {}
+    for parser in PARSERS:
+        with input_file(log_file) as build_log:
+            results[parser] = parse_build_log(
+                build_log,
+                proj_dir=pwd,
+                exclude_files=[],
+                parser=parser)
+
+    fast, bashlex = results['fast'], results['bashlex']
+    assert fast.compdb == bashlex.compdb
+    assert (fast.count, fast.skipped) == (bashlex.count, bashlex.skipped)
+
+
+def test_fast_parser_shell_constructs():
+    pwd = getcwd()
+    build_log = [
+        'FOO=bar ccache gcc -DX=\\"1\\" -c "a b.c" -o a.o 2>&1 > build.log\n',
+        '( cd sub && g++ -c main.cpp ) || { echo failed; exit 1; }\n',
+        'if test -f x.c; then gcc -c x.c; fi # comment\n',
+    ]
+    result = parse_build_log(
+        build_log,
+        proj_dir=pwd,
+        exclude_files=[],
+        parser='fast')
+
+    assert result.count == 3
+    assert result.skipped == 0
+    assert [c['arguments'] for c in result.compdb] == [
+        ['gcc', '-DX="1"', '-c', 'a b.c', '-o', 'a.o', 'build.log'],
+        ['g++', '-c', 'main.cpp'],
+        ['gcc', '-c', 'x.c'],
+    ]
+
+
+def test_single_parse_without_substitutions(monkeypatch):
+    calls = []
+    parse = bashlex.parser.parse
+
+    def counting_parse(line):
+        calls.append(line)
+        return parse(line)
+
+    monkeypatch.setattr(bashlex.parser, 'parse', counting_parse)
+    commands = CommandProcessor.process('gcc -c main.c -o main.o && g++ -c foo.cpp', getcwd())
+    assert [c['filepath'] for c in commands] == ['main.c', 'foo.cpp']
+    assert len(calls) == 1
+
+
+def test_substitutions_in_all_trees():
+    line = 'gcc -c $(echo a.c)\ng++ -c `echo b.cpp`'
+    commands = CommandProcessor.process(line, getcwd())
+    assert [c['tokens'] for c in commands] == [
+        ['gcc', '-c', 'a.c'],
+        ['g++', '-c', 'b.cpp'],
+    ]
+
+
+def test_parallel_parsing_matches_serial(monkeypatch):
+    monkeypatch.setattr(compiledb.parser, 'PARALLEL_CHUNK_SIZE', 3)
+    build_log = []
+    for i in range(4):
+        build_log += [
+            "make[1]: Entering directory '/tmp/dir{}'\n".format(i),
+            'gcc -c file{}.c\n'.format(i),
+            'echo "CC file{}.o"\n'.format(i),
+            'g++ -c -o obj{0}.o \\\n  src{0}.cpp\n'.format(i),
+            'gcc -c "unterminated\n',
+            "make[1]: Leaving directory '/tmp/dir{}'\n".format(i),
+        ]
+    serial = parse_build_log(build_log, proj_dir=getcwd(), exclude_files=[])
+    parallel = parse_build_log(build_log, proj_dir=getcwd(), exclude_files=[], jobs=2)
+
+    assert parallel.compdb == serial.compdb
+    assert len(parallel.compdb) == 8
+    assert parallel.compdb[-1]['directory'] == '/tmp/dir3'
+    assert (parallel.count, parallel.skipped, parallel.filtered) == (serial.count, serial.skipped, serial.filtered)
+
+
+@pytest.mark.parametrize('subst_jobs', [1, 4])
+def test_command_substitutions_are_cached(subst_jobs):
+    pwd = getcwd()
+    build_log = [
+        'gcc $(echo -DFOO) -c a.c\n',
+        'gcc $(echo -DFOO) -c b.c $(echo -DBAR)\n',
+        'gcc $(echo -DFOO) -c c.c\n',
+        'gcc $(date +%N) -c d.c\n',
+        'gcc $(date +%N) -c e.c\n',
+    ]
+    result = parse_build_log(
+        build_log,
+        proj_dir=pwd,
+        exclude_files=[],
+        subst_jobs=subst_jobs,
+        subst_nocache=['^date '])
+
+    assert result.count == 5
+    assert [c['arguments'][1] for c in result.compdb[:3]] == ['-DFOO'] * 3
+    assert result.compdb[1]['arguments'][-1] == '-DBAR'
+    assert result.subst_hits == 2
+    assert result.subst_misses == 4
+
+
+def test_command_substitution_timeout():
+    pwd = getcwd()
+    build_log = ['gcc $(sleep 5) -c a.c\n', 'gcc -c b.c\n']
+    result = parse_build_log(
+        build_log,
+        proj_dir=pwd,
+        exclude_files=[],
+        subst_timeout=0.1)
+
+    assert result.count == 1
+    assert result.skipped == 1
+    assert result.compdb[0]['file'] == 'b.c'
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+#
+#   compiledb: Tool for generating LLVM Compilation Database
+#   files for make-based build systems.
+#
+#   Copyright (c) 2017 Nick Diego Yamane <nick.diego@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+from click.testing import CliRunner
+
+from compiledb import generate
+from compiledb.cli import cli
+from compiledb.client import request
+from compiledb.commands.serve import CompdbServer
+from compiledb.parser import Error
+
+
+@pytest.fixture
+def server(tmp_path):
+    path = tmp_path / 'compile_commands.json'
+    path.write_text(json.dumps([{'directory': str(tmp_path), 'file': 'old.c', 'arguments': ['cc', '-c', 'old.c']}]))
+    with open(str(path), 'a+') as outfile:
+        server = CompdbServer(str(tmp_path / 'compiledb.sock'), outfile, persist_delay=60)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            yield server
+        finally:
+            server.shutdown()
+            thread.join()
+            server.server_close()
+
+
+def test_server_merges_entries(server):
+    def run(build_log, overwrite=False):
+        with open(server.outfile.name, 'a+') as outfile:
+            assert generate(infile=build_log, outfile=outfile, build_dir=os.path.dirname(server.path), exclude_files=[],
+                            overwrite=overwrite, server=server.path)
+
+    run(['gcc -c a.c\n', 'gcc -c b.c\n'])
+    run(['gcc -O2 -c a.c\n', 'gcc -c c.c\n'])
+    assert [e['arguments'] for e in server.entries.values()] == [
+        ['cc', '-c', 'old.c'], ['gcc', '-O2', '-c', 'a.c'], ['gcc', '-c', 'b.c'], ['gcc', '-c', 'c.c']]
+
+    # Persisting is deferred
+    with open(server.outfile.name) as f:
+        assert len(json.load(f)) == 1
+    assert request(server.path, 'status') == {'entries': 4, 'pending': True}
+    assert request(server.path, 'flush') == {'entries': 4}
+    with open(server.outfile.name) as f:
+        assert [e['file'] for e in json.load(f)] == ['old.c', 'a.c', 'b.c', 'c.c']
+
+    run(['gcc -c d.c\n'], overwrite=True)
+    assert list(server.entries) == [os.path.join(os.path.dirname(server.path), 'd.c')]
+
+
+def test_server_errors(server):
+    with pytest.raises(Error, match='Unknown command'):
+        request(server.path, 'restart')
+    with pytest.raises(Error, match='already listening'):
+        CompdbServer(server.path, server.outfile)
+    with pytest.raises(Error, match='Failed to connect'):
+        request(server.path + '.missing', 'status')
+
+
+def test_serve_command_stop(tmp_path, monkeypatch):
+    (tmp_path / 'a.c').write_text('')
+    (tmp_path / 'build.log').write_text('gcc -c a.c\n')
+    monkeypatch.chdir(str(tmp_path))
+    output = str(tmp_path / 'compile_commands.json')
+    socket_path = output + '.sock'
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    server = subprocess.Popen([sys.executable, '-m', 'compiledb', '-o', output, 'serve', '--persist-delay', '60'],
+                              env=env)
+    try:
+        deadline = time.monotonic() + 10
+        while not os.path.exists(socket_path) and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        result = CliRunner().invoke(cli, ['--server', socket_path, '-o', output, '-p', 'build.log',
+                                          '-d', str(tmp_path)])
+        assert result.exit_code == 0
+
+        # The database is written by the time --stop returns
+        result = CliRunner().invoke(cli, ['-o', output, 'serve', '--stop'])
+        assert result.exit_code == 0
+        with open(output) as f:
+            assert [e['file'] for e in json.load(f)] == ['a.c']
+        assert server.wait(10) == 0
+    finally:
+        if server.poll() is None:
+            server.kill()
+    assert not os.path.exists(socket_path)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+#
+#   compiledb: Tool for generating LLVM Compilation Database
+#   files for make-based build systems.
+#
+#   Copyright (c) 2017 Nick Diego Yamane <nick.diego@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import pytest
+
+from compiledb.parser import process_line
+from compiledb.tokenizer import split_commands, UnsupportedSyntax
+
+
+def test_split_simple_commands():
+    line = 'cd src && gcc -c "main file.c" -o main.o; echo \'done\' | tee log'
+    assert split_commands(line) == [
+        ('cd src', ['cd', 'src']),
+        ('gcc -c "main file.c" -o main.o', ['gcc', '-c', 'main file.c', '-o', 'main.o']),
+        ('echo \'done\'', ['echo', 'done']),
+        ('tee log', ['tee', 'log']),
+    ]
+
+
+def test_split_escapes_and_redirections():
+    line = 'CFLAGS=-O2 gcc -DNAME=\\"x\\" -c a\\ b.c 2>&1 >/dev/null'
+    assert split_commands(line) == [
+        (line, ['gcc', '-DNAME="x"', '-c', 'a b.c', '/dev/null']),
+    ]
+
+
+@pytest.mark.parametrize('line', [
+    'gcc -c `echo main.c`',
+    'gcc -c $(echo main.c)',
+    'gcc ${CFLAGS:-x} -c main.c',
+    'cat <<EOF',
+    'for f in a b; do gcc -c $f.c; done',
+    'case x in x) gcc -c x.c;; esac',
+    'if true; then gcc -c main.c',
+    'gcc -c main.c &&',
+    'gcc -c "main.c',
+    'gcc -DV=\'"1.0"\' -c a.c',
+    'gcc -DV="\'1.0\'" -c a.c',
+])
+def test_unsupported_syntax(line):
+    with pytest.raises(UnsupportedSyntax):
+        split_commands(line)
+
+
+@pytest.mark.parametrize('line', [
+    'gcc -DV=\'"1.0"\' -c a.c',
+    'gcc -DV="\'1.0\'" -c a.c',
+    'gcc -DV=\'1.0\' -DW="x y" -c a.c',
+    'gcc -DX=\'a\\b\' -c a.c',
+    'gcc -DNL=\'\\n\' -c a.c',
+    'gcc -Wl,-rpath,\'\\$ORIGIN/../lib\' -c a.c',
+])
+def test_quoting_matches_bashlex(line):
+    # Lines the tokenizer doesn't handle like bashlex fall back to it
+    fast, error = process_line(line, '/src', 'fast')
+    assert error is None
+    assert fast == process_line(line, '/src', 'bashlex')[0]
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+#
+#   compiledb: Tool for generating LLVM Compilation Database
+#   files for make-based build systems.
+#
+#   Copyright (c) 2017 Nick Diego Yamane <nick.diego@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import io
+import os
+
+import pytest
+
+from compiledb import merge_compdb
+from compiledb.utils import FileExistenceCache, FollowedStream
+
+
+@pytest.fixture
+def source_tree(tmp_path):
+    for d in ('a', 'b', 'c'):
+        (tmp_path / d).mkdir()
+        (tmp_path / d / 'main.c').write_text('')
+    return tmp_path
+
+
+@pytest.mark.parametrize('jobs', [1, 4])
+def test_file_existence_cache(source_tree, monkeypatch, jobs):
+    files = FileExistenceCache(jobs)
+    paths = [str(source_tree / d / f) for d in ('a', 'b', 'c', 'missing') for f in ('main.c', 'other.c')]
+    files.prefetch(paths)
+
+    # Further checks don't hit the file system
+    monkeypatch.setattr(os, 'scandir', None)
+    assert [files.exists(p) for p in paths] == [True, False] * 3 + [False, False]
+
+
+def test_merge_compdb_checks_files_per_directory(source_tree, monkeypatch):
+    listed = []
+    scandir = os.scandir
+
+    def counting_scandir(path):
+        listed.append(path)
+        return scandir(path)
+
+    monkeypatch.setattr(os, 'scandir', counting_scandir)
+    old = [{'directory': str(source_tree / d), 'file': f, 'arguments': ['cc', '-c', f]}
+           for d in ('a', 'b', 'c') for f in ('main.c', 'removed.c')]
+    new = [{'directory': str(source_tree / 'a'), 'file': 'main.c', 'arguments': ['cc', '-O2', '-c', 'main.c']}]
+
+    merged = list(merge_compdb(old, new))
+    assert merged == [new[0], old[2], old[4]]
+    assert sorted(listed) == sorted(str(source_tree / d) for d in ('a', 'b', 'c'))
+
+
+def test_followed_stream(tmp_path):
+    path = tmp_path / 'build.log'
+    path.write_text('gcc -c a.c\ngcc -c')
+    polls = []
+
+    def on_poll(idle):
+        if idle and True not in polls:
+            # The file grows while being followed
+            with open(str(path), 'a') as f:
+                f.write(' b.c\n')
+        polls.append(idle)
+
+    with open(str(path)) as stream:
+        lines = list(FollowedStream(stream, interval=0, timeout=0.2, on_poll=on_poll))
+    # Partially written lines are only yielded once complete
+    assert lines == ['gcc -c a.c\n', 'gcc -c b.c\n']
+    assert True in polls
+
+
+def test_followed_stream_ends_with_pipes():
+    stream = io.StringIO('gcc -c a.c\n')
+    stream.seekable = lambda: False
+    assert list(FollowedStream(stream, timeout=None)) == ['gcc -c a.c\n']
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+#
+#   compiledb: Tool for generating LLVM Compilation Database
+#   files for make-based build systems.
+#
+#   Copyright (c) 2017 Nick Diego Yamane <nick.diego@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import json
+import os
+import shlex
+import subprocess
+
+from click.testing import CliRunner
+
+from compiledb.cli import cli
+from tests.common import FakeCommand
+
+
+def test_wrap_and_collect(tmp_path, monkeypatch):
+    # Fake compiler, exiting with the status given by $FAKE_CC_STATUS
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    fake_cc = FakeCommand(bin_dir / 'gcc', 'exit ${FAKE_CC_STATUS:-0}\n', tmp_path / 'calls.log')
+    (tmp_path / 'sub').mkdir()
+    for name in ('a.c', 'sub/b.c'):
+        (tmp_path / name).write_text('')
+    monkeypatch.chdir(str(tmp_path))
+    output = str(tmp_path / 'compile_commands.json')
+
+    result = CliRunner().invoke(cli, ['-o', output, 'wrap'])
+    assert result.exit_code == 0
+    wrapper = shlex.split(result.output)
+    assert wrapper[-1] == '--spool={}.spool'.format(output)
+
+    env = dict(os.environ, PATH='{}:{}'.format(bin_dir, os.environ['PATH']))
+    assert subprocess.call(wrapper + ['gcc', '-DX="y z"', '-c', 'a.c'], env=env) == 0
+    assert subprocess.call(wrapper + ['gcc', '-c', 'b.c'], cwd=str(tmp_path / 'sub'), env=env) == 0
+    # The compiler status is returned, and failed commands are recorded as well
+    env['FAKE_CC_STATUS'] = '3'
+    assert subprocess.call(wrapper + ['gcc', '-c', 'c.c'], env=env) == 3
+    assert fake_cc.invocations() == ['-DX="y z" -c a.c', '-c b.c', '-c c.c']
+
+    result = CliRunner().invoke(cli, ['-o', output, 'collect'])
+    assert result.exit_code == 0
+    with open(output) as f:
+        compdb = [(e['directory'], e['arguments']) for e in json.load(f)]
+    # c.c doesn't exist
+    assert compdb == [(str(tmp_path), ['gcc', '-DX="y z"', '-c', 'a.c']),
+                      (str(tmp_path / 'sub'), ['gcc', '-c', 'b.c'])]
+    assert os.listdir(output + '.spool') == []
+
+
+def test_collect_keeps_spool_on_failure(tmp_path, monkeypatch):
+    (tmp_path / 'a.c').write_text('')
+    monkeypatch.chdir(str(tmp_path))
+    output = str(tmp_path / 'compile_commands.json')
+    spool_dir = tmp_path / 'compile_commands.json.spool'
+    spool_dir.mkdir()
+    record = {'directory': str(tmp_path), 'arguments': ['gcc', '-c', 'a.c']}
+    (spool_dir / '1.jsonl').write_text(json.dumps(record) + '\n')
+
+    # Writing the entries fails, as there is no server listening
+    result = CliRunner().invoke(cli, ['-o', output, '--server', str(tmp_path / 'none.sock'), 'collect'])
+    assert result.exit_code == 1
+    assert os.listdir(str(spool_dir)) == ['1.jsonl.collecting']
+
+    # The next collect picks the commands up
+    result = CliRunner().invoke(cli, ['-o', output, 'collect'])
+    assert result.exit_code == 0
+    with open(output) as f:
+        assert [e['arguments'] for e in json.load(f)] == [['gcc', '-c', 'a.c']]
+    assert os.listdir(str(spool_dir)) == []